@@ -1,15 +1,36 @@
 import pandas as pd
 from langchain.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
-from openai import OpenAI
+import asyncio
+import hashlib
+import json
+import re
 import time
-import requests
 import os
 from datetime import datetime
-from src.models import ManagerCommand, State, ResearchState, AnalyticsState, SynthersizerState
+from langgraph.config import get_stream_writer
+from src.artifacts import collect_container_artifacts, get_artifact_dir, store_artifacts
+from src.clients import get_async_openai, get_chat_model
+from src.file_registry import get_or_upload_file
+from src.openai_scheduler import openai_scheduler, openai_priority, backoff_delay, PRIORITY_NORMAL
+from src.llm_cache import cached_llm_call
+from src.research_library import get_research_library, instructions_text, RESEARCH_REUSE_ENABLED
+from src.research_planner import plan_research, merge_research_reports
+from src.telemetry import record_openai_usage
+from src.research_runs import get_latest_run, save_run, get_plan, save_plan, poll_response, PENDING_STATUSES
+from src.ingestion import archive_dataset_bundle
+from src.preaggregation import should_preaggregate, build_preaggregated_bundle
+from src.profiling import profile_dataset, format_profile
+from src.models import ManagerCommand, SynthesizerReport, State, ResearchState, AnalyticsState, SynthersizerState
 from dotenv import load_dotenv
 load_dotenv()
 
+# The synthesizer looks at this many of the analytics charts at most
+MAX_SYNTHESIZER_IMAGES = 4
+# "structured" gets the report, impact, confidence and payback in one response,
+# "separate" writes the report and asks the impact estimator for the number alongside it,
+# "both" does the structured call and runs the estimator in parallel as a cross-check
+SYNTHESIZER_MODE = os.getenv("SYNTHESIZER_MODE", "structured")
+
 # --------------------------------------------
 #              Manager Agent
 # --------------------------------------------
@@ -17,30 +38,30 @@ load_dotenv()
 
 def get_data_summary(data_path):
 
-    file_name, file_extension = os.path.splitext(data_path)
-    if file_extension == ".xlsx":
-        df = pd.read_excel(data_path)
-    elif file_extension == ".csv":
-        df = pd.read_csv(data_path)
-    else:
-        raise ValueError("Unsupported file extension")
+    # Profiled in chunks and cached by content hash, nothing is written to the cwd
+    return format_profile(profile_dataset(data_path))
 
-    with open('info_output.txt','w') as file_out:
-        df.info(buf=file_out)
 
-    with open('info_output.txt','r') as file_in:
-        summary = file_in.read()
+def get_dataset_tables(state):
 
-    return summary
+    # Requests coming through the API carry a bundle with every uploaded table,
+    # the streamlit app and individual agent tests still pass a single data_path
+    manifest = state.get("dataset_manifest")
+    if manifest and manifest.get("tables"):
+        return [(table["name"], table["path"]) for table in manifest["tables"]]
+    data_path = state["data_path"]
+    return [(os.path.splitext(os.path.basename(data_path))[0], data_path)]
 
 
-def manager_command(state: State):
+async def manager_command(state: State):
 
-    manager = ChatOpenAI(model='gpt-4o-mini', temperature=0.0).with_structured_output(ManagerCommand)
+    manager = get_chat_model('gpt-4o-mini', temperature=0.0).with_structured_output(ManagerCommand)
 
     business_profile = state["business_profile"]
-    data_path = state["data_path"]
-    data_summary = get_data_summary(data_path)
+    # Profiling is CPU and disk bound, so it runs off the event loop, one table per thread
+    tables = get_dataset_tables(state)
+    summaries = await asyncio.gather(*[asyncio.to_thread(get_data_summary, path) for _, path in tables])
+    data_summary = "\n\n".join(f"Table {name}:\n{summary}" for (name, _), summary in zip(tables, summaries))
 
     sys_prompt = "You are the manager of business consulting team. You have at your command research specialist \
                that can look up industry standards and practices and a data analytics expert that can analyze data and draw valuable insights. \
@@ -51,14 +72,21 @@ def manager_command(state: State):
 
     user_prompt = f"The client specified having the following business profile: {state['business_profile']} \n \
               His goal while using our consulting services is the following: {state['goal']} \
-              He also uploaded tabular data with the path {state['data_path']}. This is a summary of it: {data_summary}"
+              He also uploaded tabular data. This is a summary of it: {data_summary}"
+
+    async def call_manager():
+        command = await manager.ainvoke(
+            [
+                SystemMessage(content=sys_prompt),
+                HumanMessage(content=user_prompt)
+            ]
+        )
+        return command.model_dump_json()
 
-    manager_command = manager.invoke(
-        [
-            SystemMessage(content=sys_prompt),
-            HumanMessage(content=user_prompt)
-        ]
-    )
+    # Same profile, goal and data give the same instructions, so re-runs don't pay for this call again
+    manager_json = await cached_llm_call('gpt-4o-mini', [sys_prompt, user_prompt], call_manager,
+                                         schema=ManagerCommand.model_json_schema(), bypass=state.get("bypass_llm_cache", False))
+    manager_command = ManagerCommand.model_validate_json(manager_json)
 
     return {"research_instructions": manager_command.research_instructions, "analytics_instructions": manager_command.analytics_instructions}
 
@@ -67,7 +95,7 @@ def manager_command(state: State):
 #              Research Agent
 # --------------------------------------------
 
-def simplify_prompt(prompt, client):
+async def simplify_prompt(prompt, client, bypass_cache=False):
 
     input_text = f"""I'll provide you with a prompt that caused the OpenAI's o3-deep-research model to have a Rate Limit 
     Error for exceeding the 200k token limit. Your goal is to simplify the task in the prompt such that it makes it less 
@@ -77,24 +105,34 @@ def simplify_prompt(prompt, client):
     Here's the prompt you need to simplify:
     {prompt}"""
 
-    response = client.responses.create(
-            model="gpt-4o-mini",
-            input=input_text,
-        )
-    return response.output_text
+    async def call_simplifier():
+        response = await client.responses.create(
+                model="gpt-4o-mini",
+                input=input_text,
+            )
+        return response.output_text
+
+    return await cached_llm_call("gpt-4o-mini", input_text, call_simplifier, bypass=bypass_cache)
 
-def research(state: ResearchState):
+async def research(state: ResearchState):
 
-    client = OpenAI(timeout=3600)
+    # Research runs in background mode, so no request is held open while it works
+    client = get_async_openai()
+    bypass_cache = state.get("bypass_llm_cache", False)
+    library_key = instructions_text(state["research_instructions"])
+    # Submissions are tracked per request and instructions, a re-run with new instructions starts fresh
+    request_id = state.get("request_id")
+    if request_id:
+        request_id = f"{request_id}:{hashlib.sha256(library_key.encode()).hexdigest()[:12]}"
 
-    def get_research_data(input_text):
+    async def get_research_data(input_text, part, attempt):
 
         #You should consider these standards for the tasks to be accomplished: {state["research_instructions"].standards}
-        response = client.responses.create(
+        response = await client.responses.create(
             model="o3-deep-research",
             #model="o4-mini-deep-research",
             input=input_text,
-            background=False,
+            background=True,
             tools=[
                 {"type": "web_search"},
                 {
@@ -104,117 +142,157 @@ def research(state: ResearchState):
             ],
         )
 
+        # Persisted before polling so a restarted worker can pick this response back up
+        if request_id:
+            await asyncio.to_thread(save_run, request_id, part, attempt, response.id, input_text, response.status)
+
+        response = await poll_response(client, response.id)
+        # Background runs use their tokens after the submission went through the scheduler, charge them now
+        # so the next submissions wait for the model's tokens per minute to come back
+        if response.usage:
+            openai_scheduler.consume("o3-deep-research", response.usage.total_tokens)
         return response
 
-    response = None
-    max_attempts = 3
-    attempt = 0
-    input_text = f"""You have this task: {state["research_instructions"].tasks}
-            You should accomplish it while mainting this focus: {state["research_instructions"].focus}
-            """
-    # When given complex tasks, the model is likely to do so much it runs out of tokens
-    # Therefore, we write a retry system that simplifies the prompt/task for the model on each attempt
-    while response is None and attempt < max_attempts:
-        print(f"Attempt {attempt}")
-        try:
-            print(f"Trying prompt: {input_text}")
-            start = datetime.now()
-            response = get_research_data(input_text)
-            print("Research Latency:", datetime.now() - start)
-        except Exception as e:
-            print(f"Error: {e}; Trying again")
-            response = None
-            input_text = simplify_prompt(input_text, client)
-            attempt += 1
-            time.sleep(2)
-
-    return {"research_report": response.output_text}
+    async def run_research_part(part, input_text):
+
+        response = None
+        max_attempts = 3
+        attempt = 0
+        resume_id = None
+
+        # If this request already submitted research (e.g. the worker restarted mid-job), re-attach to it
+        latest_run = await asyncio.to_thread(get_latest_run, request_id, part) if request_id else None
+        if latest_run:
+            attempt, input_text = latest_run["attempt"], latest_run["input_text"]
+            if latest_run["status"] in PENDING_STATUSES + ("completed",):
+                resume_id = latest_run["response_id"]
+            else:
+                input_text = await simplify_prompt(input_text, client, bypass_cache=bypass_cache)
+                attempt += 1
+
+        # When given complex tasks, the model is likely to do so much it runs out of tokens
+        # Therefore, we write a retry system that simplifies the prompt/task for the model on each attempt
+        while response is None and attempt < max_attempts:
+            print(f"Part {part}, attempt {attempt}")
+            try:
+                start = datetime.now()
+                if resume_id:
+                    response_id, resume_id = resume_id, None
+                    print(f"Re-attaching to research {response_id}")
+                    response = await poll_response(client, response_id)
+                else:
+                    print(f"Trying prompt: {input_text}")
+                    response = await get_research_data(input_text, part, attempt)
+                print(f"Research Latency (part {part}):", datetime.now() - start)
+            except Exception as e:
+                print(f"Error: {e}; Trying again")
+                response = None
+                delay = backoff_delay(attempt)
+                if getattr(e, "code", None) == "rate_limit_exceeded":
+                    # The other parts and jobs would run into the same limit, hold every deep research submission
+                    openai_scheduler.pause("o3-deep-research", delay)
+                input_text = await simplify_prompt(input_text, client, bypass_cache=bypass_cache)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+        return response.output_text if response is not None else None
+
+    # Near-identical instructions were often already researched for another client, serve those when fresh enough
+    plan = await asyncio.to_thread(get_plan, request_id) if request_id else None
+    if plan is None and RESEARCH_REUSE_ENABLED and not bypass_cache:
+        library_report, similarity = await asyncio.to_thread(get_research_library().find, library_key)
+        if library_report is not None:
+            print(f"Reusing a past research report (similarity {similarity:.2f})")
+            return {"research_report": library_report}
+
+    # Task lists too big for one run are split up front into parts researched in parallel,
+    # instead of finding out through rate limit errors. A resumed run keeps its original plan
+    if plan is None:
+        plan = await asyncio.to_thread(plan_research, state["research_instructions"])
+        if request_id:
+            await asyncio.to_thread(save_plan, request_id, plan)
+    print(f"Research plan: ~{plan['estimated_tokens']} tokens for {plan['task_count']} tasks (budget {plan['budget']}), {len(plan['prompts'])} part(s)")
+
+    reports = await asyncio.gather(*[run_research_part(part, prompt) for part, prompt in enumerate(plan["prompts"])])
+    if all(report is None for report in reports):
+        raise RuntimeError("Every research attempt failed")
+    research_report = merge_research_reports(plan, reports)
+
+    # A report missing a failed part isn't shared, other requests would get it without knowing what's missing
+    if RESEARCH_REUSE_ENABLED and all(report is not None for report in reports):
+        await asyncio.to_thread(get_research_library().add, library_key, research_report)
+
+    return {"research_report": research_report}
 
 
 # --------------------------------------------
 #              Analytics Agent
 # --------------------------------------------
 
-def get_graph_from_agent(response):
-
-
-    container_id = ""
-    container_file_id = ""
-    container_filename = "no.no"
-    for item in response.output:
-      try:
-        container_id = item.content[0].annotations[0].container_id
-        container_file_id = item.content[0].annotations[0].file_id
-        container_filename = item.content[0].annotations[0].filename
-        print("Succesful Item")
-        print(item)
-      except Exception as e:
-        pass
-
-    _, file_extension = os.path.splitext(container_filename)
-    is_image = file_extension in [".png", ".jpg", ".jpeg"]
-    if container_id and container_file_id and is_image:
-
-        OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-
-        url = f"https://api.openai.com/v1/containers/{container_id}/files/{container_file_id}/content"
-
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}"
-        }
-
-        response = requests.get(url, headers=headers)
-
-        binary_data = response.content
-
-        # Example: save to disk
-        local_file_path = "graph.png"
-        with open(local_file_path, "wb") as f:
-            f.write(binary_data)
-
-        return local_file_path
-
+async def analytics(state: AnalyticsState):
+
+    manifest = state.get("dataset_manifest")
+    client = get_async_openai()
+
+    if manifest and manifest.get("tables"):
+        data_note = ""
+        if should_preaggregate(manifest):
+            # Large datasets are summarized locally into group-bys, distributions and a sample,
+            # so the upload and the container's work don't grow with the row count
+            derived_manifest = await asyncio.to_thread(build_preaggregated_bundle, manifest, state["analytics_instructions"])
+            if derived_manifest["tables"]:
+                manifest = derived_manifest
+                data_note = """These tables were pre-aggregated from the client's full dataset: "_by_" tables are group-bys with sums,
+    means and row counts, "_distributions" tables hold histograms and quantiles, and "_sample" tables are a stratified row sample.
+    Totals and distributions are exact for the full data, use the sample only for row-level exploration.
+    """
+        # All tables go up as one zip of Parquet files instead of one upload per file
+        data_path = manifest.get("archive_path") or await asyncio.to_thread(archive_dataset_bundle, manifest)
+        table_list = "\n".join(f"- {table['name']}.parquet: {table['rows']} rows, columns {', '.join(table['columns'])}" for table in manifest["tables"])
+        data_description = f"""The data is in the uploaded zip file. Extract it first, it contains a manifest.json and these Parquet tables:
+    {table_list}
+    {data_note}"""
     else:
+        data_path = state["data_path"]
+        data_description = ""
 
-        return None
-    
-def analytics(state: AnalyticsState):
-
-    data_path = state["data_path"]
-    client = OpenAI()
-
-    upload_file = client.files.create(file=open(data_path, "rb"), purpose="user_data",
-        expires_after={"anchor": "created_at", "seconds": 43200})
-
-    file_id = upload_file.id
+    # Same content as a previous run reuses that upload instead of sending the data again
+    file_id = await get_or_upload_file(client, data_path, purpose="user_data")
 
     instructions = f"""You have these tasks: {state["analytics_instructions"].tasks}
     You should accomplish them while mainting this focus: {state["analytics_instructions"].focus}
-    
+    {data_description}
     If you generate in image like a histogram, do NOT use plt.show(), you NEED to use plt.savefig()
     and return the image as an output file. Rmember, you NEED TO SAVE the image.
     """
 
     #You should consider these standards for the tasks to be accomplished: {state["analytics_instructions"].standards}
 
-    response = client.responses.create(
-      model="gpt-4.1",
-      tools=[{"type":"code_interpreter", "container": {"type":"auto", "file_ids":[file_id]}}],
-      input=instructions
-    )
+    # Holds its connection for minutes while the code runs, short calls of other jobs go ahead of it
+    with openai_priority(PRIORITY_NORMAL):
+        response = await client.responses.create(
+          model="gpt-4.1",
+          tools=[{"type":"code_interpreter", "container": {"type":"auto", "file_ids":[file_id]}}],
+          input=instructions
+        )
 
-    graph_file_path = get_graph_from_agent(response)
+    # Every chart and table the agent produced lands in this request's own artifact directory
+    artifacts = await collect_container_artifacts(client, response, get_artifact_dir(state.get("request_id")))
+    # Also kept in the content-addressed store, which outlives the run and serves the files to clients
+    artifacts = await asyncio.to_thread(store_artifacts, artifacts)
+    images = [artifact["path"] for artifact in artifacts if artifact["kind"] == "image"]
+    graph_file_path = images[0] if images else None
 
-    return {"analytics_report": response.output_text, "graph_file_path": graph_file_path}
+    return {"analytics_report": response.output_text, "graph_file_path": graph_file_path, "artifacts": artifacts}
 
 
 # --------------------------------------------
 #              Synthesizer Agent
 # --------------------------------------------
 
-def get_estimated_impact(analytics_report: str):
+async def get_estimated_impact(analytics_report: str, bypass_cache=False):
 
-    client = OpenAI()
+    client = get_async_openai()
 
     input_text = f"""Based on the following analytics report, provide a single numeric value estimating the potential 
     monthly financial impact (in USD) that implementing the insights from the report could have on the business. 
@@ -222,27 +300,121 @@ def get_estimated_impact(analytics_report: str):
     Analytics Report:
     {analytics_report}"""
 
-    response = client.responses.create(
-            model="gpt-5",
-            input=input_text,
-        )
-    print("Raw response for estimated impact:", response.output_text)
-    try:
-        impact_value = float(response.output_text.strip().replace("$","").replace(",",""))
-    except:
-        impact_value = 0.0
+    async def call_estimator():
+        response = await client.responses.create(
+                model="gpt-5",
+                input=input_text,
+            )
+        return response.output_text
+
+    output_text = await cached_llm_call("gpt-5", input_text, call_estimator, bypass=bypass_cache)
+    print("Raw response for estimated impact:", output_text)
+    impact_value = parse_impact(output_text)
+    if impact_value is None and not bypass_cache:
+        # A cached answer that isn't a number would come back on every run, ask once more
+        output_text = await cached_llm_call("gpt-5", input_text, call_estimator, bypass=True)
+        impact_value = parse_impact(output_text)
+    if impact_value is None:
+        # Saved as unknown rather than as a $0 impact
+        print(f"Couldn't read an impact estimate from: {output_text!r}")
 
     return impact_value
 
-def synthesizer(state: State):
+
+def parse_impact(output_text):
+
+    # Answers like "$12,500", "12500 USD" or "~12.5k" despite the instructions. The whole answer has
+    # to be the figure, a sentence like "Over 12 months: $50,000" isn't read as 12
+    match = re.fullmatch(r"\s*(?:impact\s*[:=]?\s*)?[~≈]?\s*(?:USD|\$)?\s*(-?\d[\d,]*(?:\.\d+)?)\s*([kKmM]?)\s*(?:USD|dollars)?\.?\s*",
+                         output_text or "", re.IGNORECASE)
+    if not match:
+        return None
+    multiplier = {"k": 1e3, "m": 1e6}.get(match.group(2).lower(), 1)
+    return float(match.group(1).replace(",", "")) * multiplier
+
+class ReportFieldDecoder:
+    """Pulls the text of the "report" field out of a structured response while its JSON is still streaming"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = None
+        self.done = False
+
+    def feed(self, delta):
+
+        self.buffer += delta
+        if self.done:
+            return ""
+        if self.position is None:
+            match = re.search(r'"report"\s*:\s*"', self.buffer)
+            if not match:
+                return ""
+            self.position = match.end()
+
+        text = []
+        i = self.position
+        while i < len(self.buffer):
+            char = self.buffer[i]
+            if char == '"':
+                self.done = True
+                break
+            if char == "\\":
+                # Escapes are decoded once they're complete, a split one waits for the next delta
+                length = 6 if self.buffer[i + 1:i + 2] == "u" else 2
+                if i + length > len(self.buffer):
+                    break
+                text.append(json.loads(f'"{self.buffer[i:i + length]}"'))
+                i += length
+                continue
+            text.append(char)
+            i += 1
+        self.position = i
+        return "".join(text)
+
+
+def get_writer():
+
+    # Outside of a graph run (e.g. testing an agent on its own) there's nobody to stream to
+    try:
+        return get_stream_writer()
+    except RuntimeError:
+        return None
+
+
+async def stream_report(client, inputs, text_format=None):
+    """Runs the synthesizer's gpt-5 call streamed, sending the report's tokens to the graph's event stream"""
+
+    writer = get_writer()
+    decoder = ReportFieldDecoder() if text_format else None
+    options = {"text_format": text_format} if text_format else {}
+
+    async with client.responses.stream(model="gpt-5", input=inputs, **options) as stream:
+        async for event in stream:
+            if event.type != "response.output_text.delta" or writer is None:
+                continue
+            delta = decoder.feed(event.delta) if decoder else event.delta
+            if delta:
+                writer({"type": "report_delta", "node": "synthesizer", "delta": delta})
+        response = await stream.get_final_response()
+    # Streamed bodies aren't seen by the http client hooks, count the tokens here
+    record_openai_usage(response.model, response.usage)
+    return response
+
+
+async def synthesizer(state: State):
 
     business_profile = state["business_profile"]
     goal = state["goal"]
     research_report = state["research_report"]
     analytics_report = state["analytics_report"]
     graph_file_path = state["graph_file_path"]
+    artifacts = state.get("artifacts") or []
+    images = [artifact["path"] for artifact in artifacts if artifact["kind"] == "image"][:MAX_SYNTHESIZER_IMAGES]
+    if not images and graph_file_path:
+        images = [graph_file_path]
+    other_files = [artifact["filename"] for artifact in artifacts if artifact["kind"] != "image"]
 
-    client = OpenAI()
+    client = get_async_openai()
 
     information_prompt = f"""You are a business advisor/consultant. Your client has the followwing busines profile:
         {business_profile}
@@ -257,27 +429,28 @@ def synthesizer(state: State):
         help the client accomplish his goal. Do NOT include any additional suggestions or questions in your answer. Only produce the 
         report wihtout anything else, as if it was ready to be officially printed."""
 
-    if graph_file_path:
+    if SYNTHESIZER_MODE != "separate":
+        command_prompt += """ Along with the report, estimate the monthly financial impact (in USD) that implementing its action 
+        items could have on the business, how confident you are in that estimate (0 to 100) and in how many months the action 
+        items would pay back their cost."""
 
-        # Function to create a file with the Files API
-        with open(graph_file_path, "rb") as file_content:
-            result = client.files.create(
-                file=file_content,
-                purpose="vision",
-            )
-        file_id = result.id
+    if other_files:
+        information_prompt += f"The analytics specialist also produced these files for the client: {', '.join(other_files)}. "
+
+    if images:
 
-        information_prompt += "The anlytics specialist has produced a graph that'll be provided for you."
+        file_ids = await asyncio.gather(*[get_or_upload_file(client, image, purpose="vision") for image in images])
+
+        information_prompt += "The anlytics specialist has produced graphs that'll be provided for you." if len(images) > 1 else "The anlytics specialist has produced a graph that'll be provided for you."
         user_prompt = information_prompt + command_prompt
 
         inputs = [{
                 "role": "user",
-                "content": [
-                    {"type": "input_text", "text": user_prompt},
+                "content": [{"type": "input_text", "text": user_prompt}] + [
                     {
                         "type": "input_image",
                         "file_id": file_id,
-                    },
+                    } for file_id in file_ids
                 ],
             }]
         
@@ -285,13 +458,30 @@ def synthesizer(state: State):
 
         inputs = information_prompt + command_prompt
 
-    response = client.responses.create(
-        model="gpt-5",
-        input=inputs
-    )
-
-    final_report = response.output_text
-
-    impact_value = get_estimated_impact(final_report)
-    
-    return {"final_report": final_report, "impact_value": impact_value, "graph_file_path": graph_file_path}
\ No newline at end of file
+    bypass_cache = state.get("bypass_llm_cache", False)
+
+    # The estimator reads the final report, like it always has, so its figures stay comparable between modes
+    if SYNTHESIZER_MODE == "separate":
+        response = await stream_report(client, inputs)
+        impact_value = await get_estimated_impact(response.output_text, bypass_cache=bypass_cache)
+        return {"final_report": response.output_text, "impact_value": impact_value, "graph_file_path": graph_file_path}
+
+    response = await stream_report(client, inputs, text_format=SynthesizerReport)
+
+    output = response.output_parsed
+    if output is None:
+        # Refused or cut short: keep whatever text came back and fall back to the estimator
+        impact_value = await get_estimated_impact(response.output_text, bypass_cache=bypass_cache)
+        return {"final_report": response.output_text, "impact_value": impact_value, "graph_file_path": graph_file_path}
+
+    if SYNTHESIZER_MODE == "both":
+        estimated_impact = await get_estimated_impact(output.report, bypass_cache=bypass_cache)
+        print(f"Synthesizer impact: {output.impact_value}, estimator impact: {estimated_impact}")
+
+    return {
+        "final_report": output.report,
+        "impact_value": output.impact_value,
+        "confidence_percentage": min(max(output.confidence_percentage, 0), 100),
+        "payback_months": max(output.payback_months, 0),
+        "graph_file_path": graph_file_path,
+    }
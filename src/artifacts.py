@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from src.jobs import check_request_id
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#     Files produced by the code interpreter
+# --------------------------------------------
+
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", os.path.join("cache", "artifacts"))
+MAX_ARTIFACT_DOWNLOADS = int(os.getenv("MAX_ARTIFACT_DOWNLOADS", "4"))
+# Finished runs keep their files here, keyed by content hash and served by /artifacts/{id}
+ARTIFACT_STORE_DIR = os.getenv("ARTIFACT_STORE_DIR", os.path.join("cache", "artifact_store"))
+ARTIFACT_STORE_MAX_BYTES = int(os.getenv("ARTIFACT_STORE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+TABLE_EXTENSIONS = (".csv", ".xlsx", ".xls", ".parquet", ".json")
+
+
+def get_artifact_dir(request_id=None):
+
+    # Each request gets its own directory, so concurrent jobs never overwrite each other's charts.
+    # The id is checked because the directory is removed with shutil.rmtree once the run is done
+    return os.path.join(ARTIFACT_DIR, check_request_id(request_id) if request_id else f"run_{uuid.uuid4().hex}")
+
+
+def evict_run_dirs(max_age, artifact_dir=None):
+    """Removes the run_<uuid> directories of runs without a request_id (the streamlit app) older than max_age seconds"""
+
+    artifact_dir = artifact_dir or ARTIFACT_DIR
+    if not os.path.isdir(artifact_dir):
+        return 0
+    removed = 0
+    now = time.time()
+    for entry in os.scandir(artifact_dir):
+        if entry.name.startswith("run_") and entry.is_dir() and now - entry.stat().st_mtime > max_age:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def artifact_kind(filename):
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return "image"
+    if extension in TABLE_EXTENSIONS:
+        return "table"
+    return "file"
+
+
+def find_container_files(response):
+    """Every container file cited in a response's output, in order and without duplicates"""
+
+    files = {}
+    for item in response.output:
+        for content in getattr(item, "content", None) or []:
+            for annotation in getattr(content, "annotations", None) or []:
+                container_id = getattr(annotation, "container_id", None)
+                file_id = getattr(annotation, "file_id", None)
+                if container_id and file_id and file_id not in files:
+                    files[file_id] = {"container_id": container_id, "file_id": file_id,
+                                      "filename": getattr(annotation, "filename", None) or file_id}
+    return list(files.values())
+
+
+async def _download(client, container_file, artifact_dir, taken, semaphore):
+
+    # Names come from the model, keep them to a safe basename and unique within the request
+    filename = re.sub(r"[^0-9A-Za-z._-]+", "_", os.path.basename(container_file["filename"])) or container_file["file_id"]
+    stem, extension = os.path.splitext(filename)
+    i = 2
+    while filename in taken:
+        filename = f"{stem}_{i}{extension}"
+        i += 1
+    taken.add(filename)
+    path = os.path.join(artifact_dir, filename)
+
+    size = 0
+    async with semaphore:
+        # Streamed to disk in chunks over the client's pooled connections
+        async with client.containers.files.content.with_streaming_response.retrieve(
+                container_file["file_id"], container_id=container_file["container_id"]) as response:
+            with open(path, "wb") as f:
+                async for chunk in response.iter_bytes(1024 * 1024):
+                    f.write(chunk)
+                    size += len(chunk)
+
+    return {
+        "filename": filename,
+        "path": path,
+        "kind": artifact_kind(filename),
+        "content_type": mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        "bytes": size,
+        "container_id": container_file["container_id"],
+        "file_id": container_file["file_id"],
+    }
+
+
+async def collect_container_artifacts(client, response, artifact_dir, max_concurrency=MAX_ARTIFACT_DOWNLOADS):
+    """
+    Downloads every file the code interpreter produced (charts, CSVs, workbooks...) into artifact_dir.
+
+    Returns the manifest: one dict per downloaded file with its local path, kind and size.
+    Files that fail to download are left out.
+    """
+    container_files = find_container_files(response)
+    if not container_files:
+        return []
+
+    os.makedirs(artifact_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    taken = set()
+    results = await asyncio.gather(*[_download(client, container_file, artifact_dir, taken, semaphore) for container_file in container_files],
+                                   return_exceptions=True)
+
+    artifacts = []
+    for container_file, result in zip(container_files, results):
+        if isinstance(result, Exception):
+            print(f"✗ Failed to download {container_file['filename']}: {str(result)}")
+        else:
+            print(f"✓ Downloaded artifact {result['filename']} ({result['bytes']} bytes)")
+            artifacts.append(result)
+    return artifacts
+
+
+# --------------------------------------------
+#        Content-addressed artifact store
+# --------------------------------------------
+
+_store_lock = threading.Lock()
+
+
+def _store_path(artifact_id, store_dir=None):
+
+    return os.path.join(store_dir or ARTIFACT_STORE_DIR, f"{artifact_id}.artifact")
+
+
+def _hash_file(path):
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_artifact(artifact, store_dir=None, max_bytes=None):
+    """Copies an artifact into the store and returns it with its id, identical files are stored once"""
+
+    store_dir = store_dir or ARTIFACT_STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    artifact_id = _hash_file(artifact["path"])
+    path = _store_path(artifact_id, store_dir)
+
+    if os.path.exists(path):
+        os.utime(path, None)
+    else:
+        # Temp file and rename, same as the snapshot cache, so a download never sees half a file
+        fd, temp_path = tempfile.mkstemp(dir=store_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, open(artifact["path"], "rb") as source:
+                shutil.copyfileobj(source, f, 1024 * 1024)
+            with open(f"{temp_path}.json", "w") as f:
+                json.dump({"filename": artifact["filename"], "content_type": artifact["content_type"]}, f)
+            os.replace(f"{temp_path}.json", os.path.join(store_dir, f"{artifact_id}.json"))
+            os.replace(temp_path, path)
+        except Exception:
+            for leftover in (temp_path, f"{temp_path}.json"):
+                if os.path.exists(leftover):
+                    os.unlink(leftover)
+            raise
+        evict_artifacts(store_dir, max_bytes)
+
+    return {**artifact, "id": artifact_id, "url": f"/artifacts/{artifact_id}"}
+
+
+def store_artifacts(artifacts, store_dir=None):
+
+    stored = []
+    for artifact in artifacts:
+        try:
+            stored.append(store_artifact(artifact, store_dir))
+        except Exception as e:
+            print(f"✗ Could not store artifact {artifact['filename']}: {str(e)}")
+            stored.append(artifact)
+    return stored
+
+
+def get_stored_artifact(artifact_id, store_dir=None):
+    """Returns (path, metadata) of a stored artifact, or None if it's unknown or was evicted"""
+
+    if not re.fullmatch(r"[0-9a-f]{64}", artifact_id):
+        return None
+    path = _store_path(artifact_id, store_dir)
+    try:
+        with open(os.path.join(store_dir or ARTIFACT_STORE_DIR, f"{artifact_id}.json"), "r") as f:
+            metadata = json.load(f)
+        # Bump the mtime so eviction is least-recently-used rather than least-recently-written
+        os.utime(path, None)
+    except FileNotFoundError:
+        return None
+    return path, metadata
+
+
+def evict_artifacts(store_dir=None, max_bytes=None):
+
+    store_dir = store_dir or ARTIFACT_STORE_DIR
+    max_bytes = ARTIFACT_STORE_MAX_BYTES if max_bytes is None else max_bytes
+
+    with _store_lock:
+        entries = []
+        total = 0
+        for entry in os.scandir(store_dir):
+            if not entry.name.endswith(".artifact"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        # Oldest access first
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+                os.unlink(path[:-len(".artifact")] + ".json")
+                total -= size
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import asdict
+import httpx
+from src.fake_services import FakeConfig, start_fake_services, make_csv
+
+# --------------------------------------------
+#        Offline end-to-end load benchmark
+# --------------------------------------------
+# Runs the real app (uvicorn src.main:app, or run_graph directly) in a child process
+# against local fakes of OpenAI, S3 and Supabase, drives concurrent load and reports
+# throughput, latency percentiles, peak RSS and open file descriptors per scenario.
+#
+#   python -m src.benchmark                                 every scenario
+#   python -m src.benchmark -s baseline -s flaky -n 40 -c 10
+#   python -m src.benchmark --output results.json           save a baseline
+#   python -m src.benchmark --baseline results.json         exit 1 on a regression
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "baseline": {"kind": "analyze", "config": FakeConfig()},
+    "slow_openai": {"kind": "analyze", "config": FakeConfig(openai_latency=0.5, research_latency=3)},
+    "flaky": {"kind": "analyze", "config": FakeConfig(openai_failure_rate=0.1, supabase_failure_rate=0.05)},
+    "large_data": {"kind": "analyze", "config": FakeConfig(data_rows=200_000)},
+    "s3_snapshots": {"kind": "retrieve_s3", "config": FakeConfig(s3_latency=0.02, snapshots=50)},
+    "graph_direct": {"kind": "graph", "config": FakeConfig()},
+}
+
+# Settings of the app under test, so a run takes seconds instead of the production pacing
+APP_ENV = {
+    "RESEARCH_POLL_INITIAL_DELAY": "0.2",
+    "RESEARCH_POLL_MAX_DELAY": "1",
+    "RESEARCH_REUSE_ENABLED": "false",
+    "PROGRESS_MIN_INTERVAL": "0.5",
+}
+POLL_INTERVAL = 0.2
+
+
+def _free_port():
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+
+    # Nearest rank, good enough for a few hundred samples
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values), max(1, math.ceil(p / 100 * len(values)))) - 1]
+
+
+class ProcessSampler(threading.Thread):
+    """Samples a process' resident memory and open file descriptors from /proc (Linux only)"""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_fds = 0
+        self._stopping = threading.Event()
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    # VmHWM is the kernel's own peak, it catches spikes between samples
+                    if line.startswith(("VmHWM:", "VmRSS:")):
+                        self.peak_rss = max(self.peak_rss, int(line.split()[1]) * 1024)
+            self.peak_fds = max(self.peak_fds, len(os.listdir(f"/proc/{self.pid}/fd")))
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            pass
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.sample()
+        self._stopping.set()
+
+
+def _child_env(fake_env, workdir):
+
+    env = {**os.environ, **fake_env, **APP_ENV}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+    env["BENCHMARK_WORKDIR"] = workdir
+    return env
+
+
+def _log_tail(path, lines=20):
+
+    with open(path, "r", errors="replace") as f:
+        return "".join(f.readlines()[-lines:])
+
+
+def start_app(env, workdir, timeout=60):
+
+    port = _free_port()
+    log = open(os.path.join(workdir, "app.log"), "w")
+    # The child runs in the scratch directory, so every cache/ and responses/ path lands there
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1", "--port", str(port),
+                                "--log-level", "warning"], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            log.close()
+            raise RuntimeError(f"App exited with {process.returncode} before /health answered, {log.name} ends with:\n{_log_tail(log.name)}")
+        try:
+            if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    log.close()
+    raise RuntimeError(f"App did not answer /health within {timeout}s, {log.name} ends with:\n{_log_tail(log.name)}")
+
+
+async def _analyze_one(client, url, supabase_url, scenario, i, timeout):
+
+    request_id = f"bench-{scenario}-{i}-{uuid.uuid4().hex[:8]}"
+    payload = {
+        "request_id": request_id,
+        # Distinct goals and files per request, so the LLM and upload caches don't turn the run into cache hits
+        "goal": f"Increase revenue of store {i}",
+        "business_profile": "A medium size general store",
+        "file_urls": [f"{supabase_url}/storage/v1/object/public/uploads/sales_{i}.csv?seed={i}"],
+    }
+    start = time.perf_counter()
+    while True:
+        response = await client.post(f"{url}/analyze", json=payload)
+        if response.status_code != 429:
+            break
+        await asyncio.sleep(min(float(response.headers.get("Retry-After", "1")), 1.0))
+    if response.status_code != 200:
+        return {"state": f"http_{response.status_code}", "seconds": time.perf_counter() - start}
+
+    while time.perf_counter() - start < timeout:
+        await asyncio.sleep(POLL_INTERVAL)
+        job = (await client.get(f"{url}/jobs/{request_id}")).json()
+        if job["state"] in ("succeeded", "failed"):
+            return {"state": job["state"], "seconds": time.perf_counter() - start, "attempts": job.get("attempts")}
+    return {"state": "timeout", "seconds": time.perf_counter() - start}
+
+
+async def _retrieve_one(client, url, scenario, i, timeout):
+
+    start = time.perf_counter()
+    response = await client.post(f"{url}/retrieve_s3", data={"client": "benchclient", "idx": -1 - i % 5}, timeout=timeout)
+    ok = response.status_code == 200 and "No snapshot" not in response.text and "Could not" not in response.text
+    return {"state": "succeeded" if ok else "failed", "seconds": time.perf_counter() - start}
+
+
+async def drive_load(kind, url, supabase_url, scenario, requests, concurrency, timeout):
+
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency * 2)
+
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+
+        async def one(i):
+            async with semaphore:
+                if kind == "retrieve_s3":
+                    return await _retrieve_one(client, url, scenario, i, timeout)
+                return await _analyze_one(client, url, supabase_url, scenario, i, timeout)
+
+        return await asyncio.gather(*[one(i) for i in range(requests)])
+
+
+def run_graph_worker(requests, concurrency):
+    """Child side of the graph_direct scenario: run_graph's async core on local CSVs, one JSON line per run"""
+
+    # Imported here, the driver process must not load the app or its env-driven settings
+    from src.graph import arun_graph
+
+    workdir = os.environ.get("BENCHMARK_WORKDIR", ".")
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            data_path = os.path.join(workdir, f"sales_{i}.csv")
+            with open(data_path, "wb") as f:
+                f.write(make_csv(5000, seed=i))
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await arun_graph({"goal": f"Increase revenue of store {i}", "business_profile": "A medium size general store",
+                                      "data_path": data_path})
+                    state = "succeeded"
+                except Exception as e:
+                    print(f"Graph {i} failed: {e}", file=sys.stderr)
+                    state = "failed"
+                print(json.dumps({"state": state, "seconds": time.perf_counter() - start}), flush=True)
+
+        await asyncio.gather(*[one(i) for i in range(requests)])
+
+    asyncio.run(main())
+
+
+def run_scenario(name, requests, concurrency, timeout):
+
+    spec = SCENARIOS[name]
+    servers, fake_env = start_fake_services(spec["config"])
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    env = _child_env(fake_env, workdir)
+    print(f"\n=== {name}: {requests} requests, concurrency {concurrency} (scratch dir {workdir})")
+
+    start = time.perf_counter()
+    try:
+        if spec["kind"] == "graph":
+            process = subprocess.Popen([sys.executable, "-m", "src.benchmark", "--graph-worker", "-n", str(requests), "-c", str(concurrency)],
+                                       cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=open(os.path.join(workdir, "app.log"), "w"), text=True)
+            sampler = ProcessSampler(process.pid)
+            sampler.start()
+            results = [json.loads(line) for line in process.stdout if line.startswith("{")]
+            process.wait()
+            seconds = time.perf_counter() - start
+        else:
+            process, url = start_app(env, workdir)
+            sampler = ProcessSampler(process.pid)
+            sampler.start()
+            start = time.perf_counter()
+            results = asyncio.run(drive_load(spec["kind"], url, servers["supabase"].url, name, requests, concurrency, timeout))
+            seconds = time.perf_counter() - start
+            sampler.sample()
+            process.terminate()
+            process.wait(10)
+        sampler.stop()
+    finally:
+        for server in servers.values():
+            server.stop()
+
+    latencies = [result["seconds"] for result in results if result["state"] == "succeeded"]
+    summary = {
+        "scenario": name,
+        "kind": spec["kind"],
+        "requests": requests,
+        "concurrency": concurrency,
+        "succeeded": len(latencies),
+        "failed": len(results) - len(latencies),
+        "seconds": round(seconds, 3),
+        "throughput_per_s": round(len(latencies) / seconds, 3) if seconds else 0.0,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "peak_rss_mb": round(sampler.peak_rss / 1024 ** 2, 1),
+        "peak_fds": sampler.peak_fds,
+        "config": asdict(spec["config"]),
+    }
+    print(f"{summary['succeeded']}/{requests} ok, {summary['throughput_per_s']}/s, p50 {summary['p50_s']}, p95 {summary['p95_s']}, "
+          f"p99 {summary['p99_s']}, peak RSS {summary['peak_rss_mb']} MB, peak fds {summary['peak_fds']}")
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """Regressions against a saved run: slower p95, lower throughput, more failures or more fds than allowed"""
+
+    previous = {result["scenario"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result["scenario"])
+        if before is None:
+            continue
+        name = result["scenario"]
+        if before["p95_s"] and result["p95_s"] and result["p95_s"] > before["p95_s"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_s']:.3f}s -> {result['p95_s']:.3f}s")
+        if result["throughput_per_s"] < before["throughput_per_s"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput_per_s']}/s -> {result['throughput_per_s']}/s")
+        if result["failed"] / result["requests"] > before["failed"] / before["requests"] + tolerance / 4:
+            regressions.append(f"{name}: failures {before['failed']} -> {result['failed']}")
+        if result["peak_fds"] > before["peak_fds"] * (1 + tolerance) + 10:
+            regressions.append(f"{name}: peak fds {before['peak_fds']} -> {result['peak_fds']}")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Offline load benchmark against local fakes of OpenAI, S3 and Supabase")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run, repeatable (default: all)")
+    parser.add_argument("-n", "--requests", type=int, default=20)
+    parser.add_argument("-c", "--concurrency", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds before a single request counts as timed out")
+    parser.add_argument("--output", help="Write the results as JSON, e.g. to use as a --baseline later")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run, exit 1 if this run regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline")
+    parser.add_argument("--graph-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.graph_worker:
+        run_graph_worker(args.requests, args.concurrency)
+        sys.exit(0)
+
+    # A scenario whose app never came up or where nothing succeeded measured nothing, the run fails
+    results = []
+    failures = []
+    for name in args.scenario or list(SCENARIOS):
+        try:
+            result = run_scenario(name, args.requests, args.concurrency, args.timeout)
+        except RuntimeError as e:
+            failures.append(f"{name}: {e}")
+            continue
+        results.append(result)
+        if not result["succeeded"]:
+            failures.append(f"{name}: none of the {result['requests']} requests succeeded")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    for problem in failures + regressions:
+        print(f"✗ {problem}")
+    sys.exit(1 if failures or regressions else 0)
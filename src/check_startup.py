@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# --------------------------------------------
+#            Cold start budget check
+# --------------------------------------------
+# Exits 1 when importing src.main in a fresh interpreter goes over budget or loads one of the
+# heavy dependencies that should only come in with the first job, or when a fresh uvicorn
+# worker takes longer than its budget to answer /health.
+#
+#   python -m src.check_startup
+#   python -m src.check_startup --import-budget 1.0 --health-budget 1.5 --skip-server
+#
+# fastapi and pydantic alone take 0.3-0.45s to import here, so the import budget leaves room for
+# a slower machine rather than for more of our own modules, those are what the heavy list guards
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only the agents, ingestion, S3 and Supabase code paths need these
+HEAVY_MODULES = ("pandas", "numpy", "pyarrow", "langchain", "langchain_core", "langchain_openai", "langgraph",
+                 "openai", "boto3", "botocore", "supabase", "cryptography", "tiktoken", "aiosqlite")
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import src.main
+seconds = time.perf_counter() - start
+heavy = sorted({name.split(".")[0] for name in sys.modules} & set(json.loads(sys.argv[1])))
+print(json.dumps({"seconds": seconds, "heavy": heavy}))
+"""
+
+
+def check_import(budget, runs=3):
+
+    # Best of a few runs, the first one also pays for a cold file system cache
+    results = []
+    for _ in range(runs):
+        probe = subprocess.run([sys.executable, "-c", IMPORT_PROBE, json.dumps(HEAVY_MODULES)], cwd=REPO_ROOT,
+                               capture_output=True, text=True)
+        if probe.returncode != 0:
+            error = (probe.stderr.strip().splitlines() or ["no output"])[-1]
+            return [f"import src.main failed: {error}"]
+        results.append(json.loads(probe.stdout.strip().splitlines()[-1]))
+    best = min(results, key=lambda result: result["seconds"])
+
+    problems = []
+    if best["seconds"] > budget:
+        problems.append(f"import src.main took {best['seconds']:.3f}s, budget {budget}s")
+    if best["heavy"]:
+        problems.append(f"import src.main loaded {', '.join(best['heavy'])}")
+    print(f"import src.main: {best['seconds']:.3f}s, heavy modules: {', '.join(best['heavy']) or 'none'}")
+    return problems
+
+
+def check_health(budget, timeout=30):
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    workdir = tempfile.mkdtemp(prefix="startup_check_")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")]))}
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1", "--port", str(port),
+                                "--log-level", "warning"], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    seconds = None
+    try:
+        while time.perf_counter() - start < timeout and process.poll() is None:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    if response.status == 200:
+                        seconds = time.perf_counter() - start
+                        break
+            except OSError:
+                time.sleep(0.02)
+    finally:
+        process.terminate()
+        process.wait(10)
+
+    if seconds is None:
+        return [f"/health never answered within {timeout}s"]
+    print(f"process start to first /health: {seconds:.3f}s")
+    return [f"/health took {seconds:.3f}s after process start, budget {budget}s"] if seconds > budget else []
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Checks the API's cold start against a time budget")
+    parser.add_argument("--import-budget", type=float, default=float(os.getenv("IMPORT_BUDGET_SECONDS", "1.0")))
+    parser.add_argument("--health-budget", type=float, default=float(os.getenv("HEALTH_BUDGET_SECONDS", "1.0")))
+    parser.add_argument("--skip-server", action="store_true", help="Only check the import, don't start uvicorn")
+    args = parser.parse_args()
+
+    problems = check_import(args.import_budget)
+    if not args.skip_server:
+        problems += check_health(args.health_budget)
+
+    for problem in problems:
+        print(f"✗ {problem}")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,131 @@
+import os
+import re
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+from src.artifacts import get_artifact_dir, evict_run_dirs
+from src.jobs import check_request_id, REQUEST_ID_PATTERN
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#        Graph checkpoints in SQLite
+# --------------------------------------------
+
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", os.path.join("cache", "checkpoints.sqlite3"))
+# Data bundles of unfinished runs are kept here so a resumed run still has its tables
+BUNDLE_DIR = os.getenv("BUNDLE_DIR", os.path.join("cache", "bundles"))
+# Results of finished runs, clients fetch them by request_id
+RESPONSES_DIR = os.getenv("RESPONSES_DIR", "responses")
+# Runs not touched for this long are deleted, finished or not
+CHECKPOINT_RETENTION = float(os.getenv("CHECKPOINT_RETENTION", str(7 * 24 * 3600)))
+RETENTION_INTERVAL = 3600
+# Artifact directories of runs without a request_id are deleted after this long
+RUN_ARTIFACT_RETENTION = float(os.getenv("RUN_ARTIFACT_RETENTION", str(24 * 3600)))
+
+_last_retention = 0.0
+
+
+async def connect_checkpointer():
+    """A saver on its own connection to the checkpoint database, kept open for the life of the caller's event loop"""
+
+    # langgraph and aiosqlite are only loaded once a checkpointed run starts, not when the API boots
+    import aiosqlite
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    if os.path.dirname(CHECKPOINT_DB_PATH):
+        os.makedirs(os.path.dirname(CHECKPOINT_DB_PATH), exist_ok=True)
+    return AsyncSqliteSaver(await aiosqlite.connect(CHECKPOINT_DB_PATH))
+
+
+@contextmanager
+def _connect():
+
+    # Retention runs at startup, before any run has created the cache directory
+    if os.path.dirname(CHECKPOINT_DB_PATH):
+        os.makedirs(os.path.dirname(CHECKPOINT_DB_PATH), exist_ok=True)
+    connection = sqlite3.connect(CHECKPOINT_DB_PATH, timeout=30, isolation_level=None)
+    try:
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoint_runs (
+                thread_id TEXT PRIMARY KEY,
+                finished INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        yield connection
+    finally:
+        connection.close()
+
+
+def get_bundle_dir(request_id):
+
+    # These paths end up in shutil.rmtree, an id like ../.. must never get this far
+    return os.path.join(BUNDLE_DIR, check_request_id(request_id))
+
+
+def get_response_path(request_id):
+
+    return os.path.join(RESPONSES_DIR, f"{check_request_id(request_id)}_response.json")
+
+
+def mark_run(thread_id, finished):
+
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO checkpoint_runs (thread_id, finished, updated_at) VALUES (?, ?, ?)",
+                           (thread_id, int(finished), time.time()))
+
+
+def _table_exists(connection, table):
+
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def compact_run(thread_id):
+    """A finished run only needs its last checkpoint, everything before it is dropped"""
+
+    with _connect() as connection:
+        if not _table_exists(connection, "checkpoints"):
+            return
+        latest = connection.execute("SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ?", (thread_id,)).fetchone()[0]
+        if latest is None:
+            return
+        connection.execute("DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id != ?", (thread_id, latest))
+        connection.execute("DELETE FROM writes WHERE thread_id = ? AND checkpoint_id != ?", (thread_id, latest))
+
+
+def apply_retention(force=False):
+    """Deletes checkpoints, bundles and results of runs older than CHECKPOINT_RETENTION, at most once per RETENTION_INTERVAL"""
+
+    global _last_retention
+    now = time.time()
+    if not force and now - _last_retention < RETENTION_INTERVAL:
+        return 0
+    _last_retention = now
+
+    with _connect() as connection:
+        expired = [row[0] for row in connection.execute("SELECT thread_id FROM checkpoint_runs WHERE updated_at < ?",
+                                                        (now - CHECKPOINT_RETENTION,)).fetchall()]
+        has_checkpoints = _table_exists(connection, "checkpoints")
+        for thread_id in expired:
+            if has_checkpoints:
+                connection.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+                connection.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+            connection.execute("DELETE FROM checkpoint_runs WHERE thread_id = ?", (thread_id,))
+            if not re.match(REQUEST_ID_PATTERN, thread_id):
+                # Recorded before request_ids were validated, its files are left alone
+                continue
+            shutil.rmtree(get_bundle_dir(thread_id), ignore_errors=True)
+            shutil.rmtree(get_artifact_dir(thread_id), ignore_errors=True)
+            if os.path.exists(get_response_path(thread_id)):
+                os.unlink(get_response_path(thread_id))
+        if expired:
+            # Give the freed pages back to the file system
+            connection.execute("VACUUM")
+
+    # Charts of runs without a request_id are only needed until the streamlit app has shown them
+    evict_run_dirs(RUN_ARTIFACT_RETENTION)
+
+    if expired:
+        print(f"Deleted checkpoints of {len(expired)} expired runs")
+    return len(expired)
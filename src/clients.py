@@ -0,0 +1,69 @@
+import asyncio
+import os
+import threading
+import urllib.parse
+import urllib.request
+import weakref
+import httpx
+from langchain_openai import ChatOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS
+from src.openai_scheduler import ScheduledTransport
+from src.telemetry import openai_event_hooks
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#        Shared async OpenAI clients
+# --------------------------------------------
+
+# Async HTTP connection pools belong to the event loop that opened them, so clients are
+# shared by every coroutine on a loop (the job scheduler runs all jobs on one loop) and
+# a fresh set is made for loops started elsewhere, like asyncio.run in the streamlit app
+_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+DEFAULT_TIMEOUT = 600
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+
+def _loop_clients():
+
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        return _clients.setdefault(loop, {})
+
+
+def _http_client():
+
+    # An httpx client given a transport ignores its own connection limits and proxy settings, and would
+    # still mount the proxies from the environment around the scheduler. So the scheduled transport gets
+    # the SDK's connection limits and the HTTPS_PROXY / ALL_PROXY proxy itself, and the client doesn't look
+    proxies = urllib.request.getproxies()
+    proxy = proxies.get("https") or proxies.get("all")
+    if proxy and urllib.request.proxy_bypass(urllib.parse.urlsplit(OPENAI_BASE_URL).hostname or ""):
+        proxy = None
+    transport = httpx.AsyncHTTPTransport(limits=DEFAULT_CONNECTION_LIMITS, proxy=proxy)
+    return DefaultAsyncHttpxClient(timeout=DEFAULT_TIMEOUT, event_hooks=openai_event_hooks(), trust_env=False,
+                                   transport=ScheduledTransport(transport))
+
+
+def get_async_openai(timeout=DEFAULT_TIMEOUT):
+
+    clients = _loop_clients()
+    key = ("openai", timeout)
+    if key not in clients:
+        # Every request is timed and its token usage counted through the http client's hooks, and queued
+        # and retried by the process-wide scheduler, which is why the SDK doesn't retry on its own
+        clients[key] = AsyncOpenAI(timeout=timeout, max_retries=0, http_client=_http_client())
+    return clients[key]
+
+
+def get_chat_model(model, temperature=0.0):
+
+    clients = _loop_clients()
+    key = ("chat", model, temperature)
+    if key not in clients:
+        # langchain otherwise falls back to one httpx client cached for the whole process
+        clients[key] = ChatOpenAI(model=model, temperature=temperature, max_retries=0,
+                                  http_async_client=_http_client())
+    return clients[key]
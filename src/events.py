@@ -0,0 +1,122 @@
+import asyncio
+import os
+import threading
+import time
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#      Live events of running analyses
+# --------------------------------------------
+
+# Events of a finished run stay around this long for clients that connect late
+EVENT_HISTORY_TTL = float(os.getenv("EVENT_HISTORY_TTL", "600"))
+MAX_EVENT_HISTORY = 2000
+HEARTBEAT_INTERVAL = 15
+
+
+class _Channel:
+
+    def __init__(self):
+        self.history = []
+        self.subscribers = set()
+        self.closed_at = None
+
+
+# Jobs publish from the scheduler's thread, subscribers listen on the server's loop,
+# so everything here goes through a plain lock and call_soon_threadsafe
+_channels = {}
+_lock = threading.Lock()
+
+
+def _prune(now):
+
+    for request_id in [request_id for request_id, channel in _channels.items()
+                       if channel.closed_at and now - channel.closed_at > EVENT_HISTORY_TTL and not channel.subscribers]:
+        del _channels[request_id]
+
+
+def _deliver(subscribers, event):
+
+    for loop, queue in subscribers:
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+
+def publish(request_id, event_type, **data):
+
+    if not request_id:
+        return
+    event = {"type": event_type, "time": time.time(), **data}
+    with _lock:
+        channel = _channels.get(request_id)
+        if channel is None:
+            channel = _channels[request_id] = _Channel()
+        elif channel.closed_at:
+            # A new run of the request starts with a clean history
+            channel.history = []
+            channel.closed_at = None
+        history = channel.history
+        if event_type == "report_delta" and history and history[-1]["type"] == "report_delta":
+            # Replayed tokens are merged, a late client gets the report so far in one event
+            history[-1] = {**history[-1], "delta": history[-1]["delta"] + event["delta"]}
+        elif len(history) < MAX_EVENT_HISTORY:
+            history.append(event)
+        subscribers = list(channel.subscribers)
+    _deliver(subscribers, event)
+
+
+def close(request_id):
+    """Marks the run's events as complete, open streams end after the last event"""
+
+    if not request_id:
+        return
+    now = time.time()
+    with _lock:
+        channel = _channels.get(request_id)
+        if channel is None:
+            return
+        channel.closed_at = now
+        subscribers = list(channel.subscribers)
+        _prune(now)
+    _deliver(subscribers, None)
+
+
+def has_events(request_id):
+
+    with _lock:
+        return request_id in _channels
+
+
+async def subscribe(request_id, heartbeat=HEARTBEAT_INTERVAL):
+    """
+    Yields the events of a request: what happened so far, then live events until the run ends.
+    Yields None every heartbeat seconds without events, so the caller can keep the connection alive.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    subscriber = (loop, queue)
+    with _lock:
+        channel = _channels.setdefault(request_id, _Channel())
+        history = list(channel.history)
+        closed = channel.closed_at is not None
+        if not closed:
+            channel.subscribers.add(subscriber)
+
+    try:
+        for event in history:
+            yield event
+        if closed:
+            return
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if event is None:
+                return
+            yield event
+    finally:
+        with _lock:
+            channel.subscribers.discard(subscriber)
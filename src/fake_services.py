@@ -0,0 +1,394 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from email.utils import formatdate
+import uvicorn
+from cryptography.fernet import Fernet
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# --------------------------------------------
+#   Local stand-ins for OpenAI, S3 and Supabase
+# --------------------------------------------
+# Only what the app actually calls is implemented, with the response shapes the
+# SDKs parse. Used by src/benchmark.py, never by the app itself.
+
+# A valid 1x1 PNG, what the fake code interpreter "draws"
+PNG_BYTES = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+LOREM = ("Revenue is concentrated in a few regions and product lines. Discounts above twenty percent erode margin "
+         "without lifting volume. Reorder the catalog around the top sellers and cap promotions. ")
+
+
+@dataclass
+class FakeConfig:
+    openai_latency: float = 0.05
+    research_latency: float = 0.5
+    stream_chunks: int = 20
+    s3_latency: float = 0.01
+    supabase_latency: float = 0.01
+    # Share of requests answered with a 500, per service
+    openai_failure_rate: float = 0.0
+    s3_failure_rate: float = 0.0
+    supabase_failure_rate: float = 0.0
+    data_rows: int = 5000
+    snapshots: int = 5
+
+
+async def _delay(latency):
+
+    if latency > 0:
+        await asyncio.sleep(latency * random.uniform(0.8, 1.2))
+
+
+def _should_fail(rate):
+
+    return rate > 0 and random.random() < rate
+
+
+# --------------------------------------------
+#               OpenAI
+# --------------------------------------------
+
+def _fake_from_schema(schema, defs=None):
+    """Smallest instance of a JSON schema that a pydantic model will accept"""
+
+    defs = defs or schema.get("$defs", {})
+    if "$ref" in schema:
+        return _fake_from_schema(defs[schema["$ref"].split("/")[-1]], defs)
+    if "anyOf" in schema:
+        return _fake_from_schema(schema["anyOf"][0], defs)
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: _fake_from_schema(prop, defs) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_fake_from_schema(schema.get("items", {}), defs)]
+    if kind == "number":
+        return round(random.uniform(1000, 20000), 2)
+    if kind == "integer":
+        return random.randint(1, 100)
+    if kind == "boolean":
+        return True
+    return LOREM.strip()
+
+
+def _usage(body, text):
+
+    input_tokens = len(json.dumps(body)) // 4
+    output_tokens = max(1, len(text) // 4)
+    return {"input_tokens": input_tokens, "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": output_tokens, "output_tokens_details": {"reasoning_tokens": output_tokens // 2},
+            "total_tokens": input_tokens + output_tokens}
+
+
+def _response_text(body):
+
+    text_format = (body.get("text") or {}).get("format") or {}
+    if text_format.get("type") == "json_schema":
+        return json.dumps(_fake_from_schema(text_format["schema"]))
+    return LOREM * 3
+
+
+def _response(body, response_id, status, text=None, annotations=None):
+
+    output = []
+    if text is not None:
+        output.append({"type": "message", "id": f"msg_{uuid.uuid4().hex}", "role": "assistant", "status": "completed",
+                       "content": [{"type": "output_text", "text": text, "annotations": annotations or [], "logprobs": []}]})
+    return {
+        "id": response_id, "object": "response", "created_at": int(time.time()), "model": body.get("model", "gpt-5"),
+        "status": status, "output": output, "usage": _usage(body, text) if text is not None else None,
+        "parallel_tool_calls": True, "tool_choice": "auto", "tools": [], "error": None, "incomplete_details": None,
+        "instructions": None, "metadata": {}, "text": body.get("text") or {"format": {"type": "text"}},
+    }
+
+
+def _sse(event):
+
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+def build_openai_app(config):
+
+    app = FastAPI()
+    background = {}
+    files = {}
+
+    @app.middleware("http")
+    async def inject(request, call_next):
+        await _delay(config.openai_latency)
+        if _should_fail(config.openai_failure_rate):
+            return JSONResponse({"error": {"message": "Injected failure", "type": "server_error"}}, status_code=500)
+        return await call_next(request)
+
+    @app.post("/v1/responses")
+    async def create_response(request: Request):
+        body = await request.json()
+        response_id = f"resp_{uuid.uuid4().hex}"
+
+        if body.get("background"):
+            background[response_id] = (body, time.monotonic() + config.research_latency * random.uniform(0.8, 1.2))
+            return _response(body, response_id, "queued")
+
+        annotations = []
+        if any(tool.get("type") == "code_interpreter" for tool in body.get("tools") or []):
+            container_id = f"cntr_{uuid.uuid4().hex}"
+            annotations = [{"type": "container_file_citation", "container_id": container_id, "file_id": f"cfile_{kind}_{uuid.uuid4().hex}",
+                            "filename": filename, "start_index": 0, "end_index": 0}
+                           for kind, filename in (("png", "revenue_by_region.png"), ("csv", "summary.csv"))]
+
+        text = _response_text(body)
+        if not body.get("stream"):
+            return _response(body, response_id, "completed", text, annotations)
+
+        async def stream():
+            item_id = f"msg_{uuid.uuid4().hex}"
+            sequence = iter(range(1_000_000))
+            yield _sse({"type": "response.created", "sequence_number": next(sequence), "response": _response(body, response_id, "in_progress")})
+            yield _sse({"type": "response.output_item.added", "sequence_number": next(sequence), "output_index": 0,
+                        "item": {"type": "message", "id": item_id, "role": "assistant", "status": "in_progress", "content": []}})
+            yield _sse({"type": "response.content_part.added", "sequence_number": next(sequence), "item_id": item_id, "output_index": 0,
+                        "content_index": 0, "part": {"type": "output_text", "text": "", "annotations": [], "logprobs": []}})
+            size = max(1, -(-len(text) // config.stream_chunks))
+            for i in range(0, len(text), size):
+                await _delay(config.openai_latency / config.stream_chunks)
+                yield _sse({"type": "response.output_text.delta", "sequence_number": next(sequence), "item_id": item_id,
+                            "output_index": 0, "content_index": 0, "delta": text[i:i + size], "logprobs": []})
+            yield _sse({"type": "response.output_text.done", "sequence_number": next(sequence), "item_id": item_id,
+                        "output_index": 0, "content_index": 0, "text": text, "logprobs": []})
+            final = _response(body, response_id, "completed", text)
+            final["output"][0]["id"] = item_id
+            yield _sse({"type": "response.content_part.done", "sequence_number": next(sequence), "item_id": item_id,
+                        "output_index": 0, "content_index": 0, "part": final["output"][0]["content"][0]})
+            yield _sse({"type": "response.output_item.done", "sequence_number": next(sequence), "output_index": 0, "item": final["output"][0]})
+            yield _sse({"type": "response.completed", "sequence_number": next(sequence), "response": final})
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/v1/responses/{response_id}")
+    async def retrieve_response(response_id: str):
+        if response_id not in background:
+            return JSONResponse({"error": {"message": "No such response", "type": "invalid_request_error"}}, status_code=404)
+        body, ready_at = background[response_id]
+        if time.monotonic() < ready_at:
+            return _response(body, response_id, "in_progress")
+        return _response(body, response_id, "completed", LOREM * 20)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        response_format = body.get("response_format") or {}
+        message = {"role": "assistant", "content": LOREM}
+        if response_format.get("type") == "json_schema":
+            message["content"] = json.dumps(_fake_from_schema(response_format["json_schema"]["schema"]))
+        elif body.get("tools"):
+            function = body["tools"][0]["function"]
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call_{uuid.uuid4().hex}", "type": "function",
+                "function": {"name": function["name"], "arguments": json.dumps(_fake_from_schema(function["parameters"]))}}]}
+        usage = _usage(body, message["content"] or "")
+        return {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model"), "choices": [{"index": 0, "message": message, "finish_reason": "stop", "logprobs": None}],
+                "usage": {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"],
+                          "total_tokens": usage["total_tokens"]}}
+
+    def file_object(file_id):
+        return {"id": file_id, "object": "file", "status": "processed", **files[file_id]}
+
+    @app.post("/v1/files")
+    async def create_file(request: Request):
+        size = len(await request.body())
+        file_id = f"file-{uuid.uuid4().hex}"
+        files[file_id] = {"bytes": size, "created_at": int(time.time()), "filename": "upload", "purpose": "user_data"}
+        return file_object(file_id)
+
+    @app.get("/v1/files/{file_id}")
+    async def retrieve_file(file_id: str):
+        if file_id not in files:
+            return JSONResponse({"error": {"message": "No such file", "type": "invalid_request_error"}}, status_code=404)
+        return file_object(file_id)
+
+    @app.delete("/v1/files/{file_id}")
+    async def delete_file(file_id: str):
+        files.pop(file_id, None)
+        return {"id": file_id, "object": "file", "deleted": True}
+
+    @app.get("/v1/containers/{container_id}/files/{file_id}/content")
+    async def container_file_content(container_id: str, file_id: str):
+        if file_id.startswith("cfile_png_"):
+            return Response(PNG_BYTES, media_type="image/png")
+        return Response("region,revenue\nwest,1200\neast,900\n", media_type="text/csv")
+
+    return app
+
+
+# --------------------------------------------
+#                 S3
+# --------------------------------------------
+
+def make_snapshot(rows, seed=0):
+
+    rng = random.Random(seed)
+    regions = ["west", "east", "north", "south"]
+    return {"tables": {"sales": [{"date": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}", "region": rng.choice(regions),
+                                  "sales": round(rng.uniform(10, 500), 2), "quantity": rng.randint(1, 10)} for i in range(rows)]}}
+
+
+def build_s3_app(config, encryption_key, bucket="bench-bucket", client_name="benchclient"):
+
+    app = FastAPI()
+    fernet = Fernet(encryption_key.encode())
+    objects = {}
+    for i in range(config.snapshots):
+        body = fernet.encrypt(json.dumps(make_snapshot(min(config.data_rows, 2000), seed=i)).encode())
+        objects[f"data/{client_name}/snapshots/snapshot_{i:03d}.json"] = (body, hashlib.md5(body).hexdigest(), 1_700_000_000 + i * 3600)
+
+    @app.middleware("http")
+    async def inject(request, call_next):
+        await _delay(config.s3_latency)
+        if _should_fail(config.s3_failure_rate):
+            return Response("<Error><Code>InternalError</Code><Message>Injected failure</Message></Error>",
+                            status_code=500, media_type="application/xml")
+        return await call_next(request)
+
+    @app.get("/{bucket_name}")
+    async def list_objects(request: Request, bucket_name: str, prefix: str = "", delimiter: str = ""):
+        start_after = request.query_params.get("start-after", "")
+        keys = sorted(key for key in objects if key.startswith(prefix) and key > start_after)
+        contents, prefixes = [], []
+        for key in keys:
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter)[0] + delimiter
+                if common not in prefixes:
+                    prefixes.append(common)
+                continue
+            body, etag, modified = objects[key]
+            contents.append(f"<Contents><Key>{key}</Key><LastModified>{time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(modified))}</LastModified>"
+                            f"<ETag>\"{etag}\"</ETag><Size>{len(body)}</Size><StorageClass>STANDARD</StorageClass></Contents>")
+        xml = (f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+               f"<Name>{bucket_name}</Name><Prefix>{prefix}</Prefix><KeyCount>{len(contents) + len(prefixes)}</KeyCount>"
+               f"<MaxKeys>1000</MaxKeys><Delimiter>{delimiter}</Delimiter><IsTruncated>false</IsTruncated>{''.join(contents)}"
+               + "".join(f"<CommonPrefixes><Prefix>{common}</Prefix></CommonPrefixes>" for common in prefixes)
+               + "</ListBucketResult>")
+        return Response(xml, media_type="application/xml")
+
+    def object_headers(key):
+        body, etag, modified = objects[key]
+        return {"ETag": f'"{etag}"', "Last-Modified": formatdate(modified, usegmt=True), "Content-Length": str(len(body))}
+
+    @app.head("/{bucket_name}/{key:path}")
+    async def head_object(bucket_name: str, key: str):
+        if key not in objects:
+            return Response(status_code=404)
+        return Response(status_code=200, headers=object_headers(key))
+
+    @app.get("/{bucket_name}/{key:path}")
+    async def get_object(bucket_name: str, key: str):
+        if key not in objects:
+            return Response("<Error><Code>NoSuchKey</Code></Error>", status_code=404, media_type="application/xml")
+        headers = object_headers(key)
+        headers.pop("Content-Length")
+        return Response(objects[key][0], headers=headers, media_type="application/octet-stream")
+
+    return app
+
+
+# --------------------------------------------
+#               Supabase
+# --------------------------------------------
+
+def make_csv(rows, seed=0):
+
+    snapshot = make_snapshot(rows, seed)["tables"]["sales"]
+    buffer = io.StringIO()
+    buffer.write("date,region,sales,quantity\n")
+    for row in snapshot:
+        buffer.write(f"{row['date']},{row['region']},{row['sales']},{row['quantity']}\n")
+    return buffer.getvalue().encode()
+
+
+def build_supabase_app(config):
+
+    app = FastAPI()
+    app.state.writes = 0
+
+    @app.middleware("http")
+    async def inject(request, call_next):
+        await _delay(config.supabase_latency)
+        if _should_fail(config.supabase_failure_rate):
+            return JSONResponse({"message": "Injected failure"}, status_code=500)
+        return await call_next(request)
+
+    @app.get("/storage/v1/object/public/{bucket}/{name}")
+    async def download(bucket: str, name: str, seed: int = 0):
+        return Response(make_csv(config.data_rows, seed), media_type="text/csv")
+
+    @app.api_route("/rest/v1/{table}", methods=["POST", "PATCH"])
+    async def write(table: str, request: Request):
+        await request.body()
+        app.state.writes += 1
+        return JSONResponse([], status_code=201 if request.method == "POST" else 200)
+
+    return app
+
+
+# --------------------------------------------
+#            Running the fakes
+# --------------------------------------------
+
+class FakeServer:
+    """Runs an ASGI app with uvicorn on a free local port in a background thread"""
+
+    def __init__(self, app):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="off"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout=10):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Fake server did not start")
+            time.sleep(0.02)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(5)
+
+
+def start_fake_services(config):
+    """
+    Starts the three fakes and returns (servers, env): the env points the app's
+    OpenAI, S3 and Supabase clients at them.
+    """
+    encryption_key = Fernet.generate_key().decode()
+    servers = {
+        "openai": FakeServer(build_openai_app(config)).start(),
+        "s3": FakeServer(build_s3_app(config, encryption_key)).start(),
+        "supabase": FakeServer(build_supabase_app(config)).start(),
+    }
+    env = {
+        "OPENAI_BASE_URL": f"{servers['openai'].url}/v1",
+        "OPENAI_API_KEY": "sk-benchmark",
+        "AWS_ENDPOINT_URL_S3": servers["s3"].url,
+        "AWS_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_S3_BUCKET": "bench-bucket",
+        "AWS_S3_ROOT_PREFIX": "data/",
+        "ENCRYPTION_KEY": encryption_key,
+        "SUPABASE_URL": servers["supabase"].url,
+        # supabase-py only checks that the key looks like a JWT
+        "SUPABASE_SERVICE_ROLE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.benchmark",
+    }
+    return servers, env
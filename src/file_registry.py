@@ -0,0 +1,141 @@
+import asyncio
+import os
+import sqlite3
+import time
+import weakref
+from contextlib import contextmanager
+import openai
+from src.profiling import get_file_hash
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#     Registry of files uploaded to OpenAI
+# --------------------------------------------
+
+FILE_REGISTRY_PATH = os.getenv("FILE_REGISTRY_PATH", os.path.join("cache", "file_registry.sqlite3"))
+# Uploads expire on OpenAI's side after this many seconds
+FILE_UPLOAD_TTL = int(os.getenv("FILE_UPLOAD_TTL", "43200"))
+# A file is only reused if it will stay alive at least this long, enough for the run using it
+FILE_REUSE_MARGIN = int(os.getenv("FILE_REUSE_MARGIN", "3600"))
+# Files nobody used for this long are deleted before they expire
+FILE_IDLE_TTL = int(os.getenv("FILE_IDLE_TTL", "14400"))
+CLEANUP_INTERVAL = 600
+
+# Entries go away on their own once no job holds or waits on the lock
+_upload_locks = weakref.WeakValueDictionary()
+_last_cleanup = 0.0
+_initialized = set()
+
+
+@contextmanager
+def _connect(db_path=None):
+
+    db_path = db_path or FILE_REGISTRY_PATH
+    if db_path not in _initialized and os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    try:
+        if db_path not in _initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS uploaded_files (
+                    sha256 TEXT NOT NULL,
+                    purpose TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    PRIMARY KEY (sha256, purpose)
+                )""")
+            _initialized.add(db_path)
+        yield connection
+    finally:
+        connection.close()
+
+
+def _lookup(sha256, purpose):
+
+    with _connect() as connection:
+        row = connection.execute("SELECT file_id FROM uploaded_files WHERE sha256 = ? AND purpose = ? AND expires_at > ?",
+                                 (sha256, purpose, time.time() + FILE_REUSE_MARGIN)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE uploaded_files SET last_used_at = ? WHERE sha256 = ? AND purpose = ?", (time.time(), sha256, purpose))
+    return row["file_id"]
+
+
+def _record(sha256, purpose, file_id, size, ttl):
+
+    now = time.time()
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO uploaded_files (sha256, purpose, file_id, size, created_at, expires_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (sha256, purpose, file_id, size, now, now + ttl, now))
+
+
+def _forget(file_id):
+
+    with _connect() as connection:
+        connection.execute("DELETE FROM uploaded_files WHERE file_id = ?", (file_id,))
+
+
+async def get_or_upload_file(client, path, purpose, ttl=FILE_UPLOAD_TTL):
+    """
+    Returns the id of a live OpenAI file with the same content as path, uploading it only if there's none.
+
+    Args:
+        client: AsyncOpenAI client
+        path: Local file to upload
+        purpose: Files API purpose, part of the registry key
+        ttl: Seconds until the uploaded file expires
+    """
+    sha256 = await asyncio.to_thread(get_file_hash, path)
+
+    # Two jobs with the same data wait for one upload instead of doing two
+    lock = _upload_locks.setdefault((sha256, purpose), asyncio.Lock())
+    async with lock:
+        file_id = await asyncio.to_thread(_lookup, sha256, purpose)
+        if file_id is not None:
+            try:
+                # Cheap check that nobody deleted it on OpenAI's side
+                await client.files.retrieve(file_id)
+                print(f"Reusing uploaded file {file_id} for {os.path.basename(path)}")
+                return file_id
+            except openai.NotFoundError:
+                await asyncio.to_thread(_forget, file_id)
+
+        with open(path, "rb") as file_content:
+            uploaded = await client.files.create(file=file_content, purpose=purpose,
+                expires_after={"anchor": "created_at", "seconds": ttl})
+        await asyncio.to_thread(_record, sha256, purpose, uploaded.id, os.path.getsize(path), ttl)
+
+    await cleanup_files(client)
+    return uploaded.id
+
+
+async def cleanup_files(client, force=False):
+    """Drops expired entries and deletes files that have sat unused for FILE_IDLE_TTL"""
+
+    global _last_cleanup
+    now = time.time()
+    if not force and now - _last_cleanup < CLEANUP_INTERVAL:
+        return
+    _last_cleanup = now
+
+    def stale_files():
+        with _connect() as connection:
+            connection.execute("DELETE FROM uploaded_files WHERE expires_at <= ?", (now,))
+            return [row["file_id"] for row in connection.execute(
+                "SELECT file_id FROM uploaded_files WHERE last_used_at <= ?", (now - FILE_IDLE_TTL,)).fetchall()]
+
+    for file_id in await asyncio.to_thread(stale_files):
+        try:
+            await client.files.delete(file_id)
+        except openai.NotFoundError:
+            pass
+        except Exception as e:
+            print(f"Could not delete file {file_id}: {e}")
+            continue
+        await asyncio.to_thread(_forget, file_id)
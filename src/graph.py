@@ -1,32 +1,192 @@
-from src.agents import *
+import asyncio
+import threading
+import time
+import weakref
+from src.agents import manager_command, research, analytics, synthesizer
+from src.models import State
+from src.events import publish
+from src.checkpoints import connect_checkpointer, mark_run, compact_run, apply_retention
+from src.jobs import record_node_timing
+from src.telemetry import observe
+from src.supabase_functions import save_report_in_supabase, report_progress, progress_reporter
 from langgraph.graph import StateGraph, START, END
 
 
-def build_graph():
+# Share of the run each node accounts for, save_report itself sets the request to 100
+NODE_PROGRESS = {"manager": 10, "research_agent": 45, "analytics_agent": 25, "synthesizer": 15}
+# The state key each of those nodes writes, a resumed run counts the ones its checkpoint already has as done
+NODE_OUTPUTS = {"manager": "research_instructions", "research_agent": "research_report", "analytics_agent": "analytics_report",
+                "synthesizer": "final_report"}
+
+
+def timed_node(name, node):
+
+    # Reports how long each node took to the job running it, if any, and the request's progress to Supabase
+    async def run_node(state):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = await node(state)
+            status = "ok"
+        finally:
+            seconds = time.perf_counter() - start
+            # A SQLite write, kept off the loop every job's nodes run on
+            await asyncio.to_thread(record_node_timing, name, seconds)
+            observe("node", name, seconds, status, state.get("request_id"))
+        if name in NODE_PROGRESS and state.get("request_id"):
+            report_progress(state.get("request_id"), node_progress(state.get("request_id"), name))
+        return result
+
+    return run_node
+
+
+_finished_nodes = {}
+
+
+def node_progress(request_id, name):
+
+    # Research and analytics finish in either order, so progress is the sum over the nodes done so far
+    finished = _finished_nodes.setdefault(request_id, set())
+    finished.add(name)
+    return sum(NODE_PROGRESS[node] for node in finished)
+
+
+async def save_report(state: State):
+
+    # Part of the graph so a failed save is retried from its checkpoint without redoing the synthesis
+    request_id = state.get("request_id")
+    if request_id:
+        await asyncio.to_thread(save_report_in_supabase, request_id, state["final_report"], state["impact_value"],
+                                state.get("confidence_percentage"), state.get("payback_months"))
+        _finished_nodes.pop(request_id, None)
+    return {}
+
+
+def build_graph(checkpointer=None):
 
     business_consulting_team_builder = StateGraph(State)
 
-    business_consulting_team_builder.add_node("manager", manager_command)
-    business_consulting_team_builder.add_node("research_agent", research)
-    business_consulting_team_builder.add_node("analytics_agent", analytics)
-    business_consulting_team_builder.add_node("synthesizer", synthesizer)
+    business_consulting_team_builder.add_node("manager", timed_node("manager", manager_command))
+    business_consulting_team_builder.add_node("research_agent", timed_node("research_agent", research))
+    business_consulting_team_builder.add_node("analytics_agent", timed_node("analytics_agent", analytics))
+    business_consulting_team_builder.add_node("synthesizer", timed_node("synthesizer", synthesizer))
+    business_consulting_team_builder.add_node("save_report", timed_node("save_report", save_report))
 
     business_consulting_team_builder.add_edge(START, "manager")
     business_consulting_team_builder.add_edge("manager", "research_agent")
     business_consulting_team_builder.add_edge("manager", "analytics_agent")
     business_consulting_team_builder.add_edge("research_agent", "synthesizer")
     business_consulting_team_builder.add_edge("analytics_agent", "synthesizer")
-    business_consulting_team_builder.add_edge("synthesizer", END)
+    business_consulting_team_builder.add_edge("synthesizer", "save_report")
+    business_consulting_team_builder.add_edge("save_report", END)
 
-    business_consulting_team = business_consulting_team_builder.compile()
+    business_consulting_team = business_consulting_team_builder.compile(checkpointer=checkpointer)
 
     return business_consulting_team
 
-def run_graph(graph_input):
 
-    business_consulting_team = build_graph()
-    state = business_consulting_team.invoke(graph_input)
+_graph = None
+_graph_lock = threading.Lock()
+# The checkpointer's sqlite connection belongs to the event loop that opened it, so each loop
+# (in practice the job scheduler's) gets its own long-lived copy of the graph bound to one
+_checkpointed_graphs = weakref.WeakKeyDictionary()
+_loop_locks = weakref.WeakKeyDictionary()
+
+
+def get_graph():
+    """The graph without a checkpointer, compiled once per process"""
+
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                _graph = build_graph()
+    return _graph
+
+
+async def get_checkpointed_graph():
+
+    loop = asyncio.get_running_loop()
+    with _graph_lock:
+        lock = _loop_locks.setdefault(loop, asyncio.Lock())
+    async with lock:
+        graph = _checkpointed_graphs.get(loop)
+        if graph is None:
+            # A copy shares the compiled nodes and channels, only the checkpointer differs
+            graph = get_graph().copy(update={"checkpointer": await connect_checkpointer()})
+            _checkpointed_graphs[loop] = graph
+    return graph
+
+
+async def get_resumable_nodes(request_id):
+    """Nodes an unfinished run of this request would continue from, empty if there's nothing to resume"""
+
+    snapshot = await (await get_checkpointed_graph()).aget_state({"configurable": {"thread_id": request_id}})
+    return snapshot.next
+
+
+async def stream_graph(graph, graph_input, config):
+    """Runs the graph like ainvoke, publishing node starts and finishes and the synthesizer's tokens as it goes"""
+
+    request_id = config["configurable"]["thread_id"]
+    state = None
+    async for mode, chunk in graph.astream(graph_input, config, stream_mode=["tasks", "custom", "values"]):
+        if mode == "values":
+            state = chunk
+        elif mode == "tasks":
+            if "triggers" in chunk:
+                publish(request_id, "node_started", node=chunk["name"])
+            else:
+                publish(request_id, "node_finished", node=chunk["name"], error=str(chunk["error"]) if chunk.get("error") else None)
+        elif mode == "custom":
+            publish(request_id, chunk["type"], **{key: value for key, value in chunk.items() if key != "type"})
+    return state
+
+
+async def arun_graph_state(graph_input):
+    """Runs the graph and returns its final state"""
+
+    request_id = graph_input.get("request_id")
+
+    if not request_id:
+        state = await get_graph().ainvoke(graph_input)
+    else:
+        # Every run of a request is checkpointed under its request_id, so a run that failed
+        # part way continues from the node that failed instead of starting over
+        config = {"configurable": {"thread_id": request_id}}
+        await asyncio.to_thread(mark_run, request_id, False)
+        business_consulting_team = await get_checkpointed_graph()
+        snapshot = await business_consulting_team.aget_state(config)
+        try:
+            if snapshot.next:
+                print(f"Resuming {request_id} at {', '.join(snapshot.next)}")
+                # Progress carries on from the nodes finished before the failure instead of starting again from 0
+                _finished_nodes[request_id] = {node for node, key in NODE_OUTPUTS.items()
+                                               if node not in snapshot.next and snapshot.values.get(key)}
+                state = await stream_graph(business_consulting_team, None, config)
+            else:
+                state = await stream_graph(business_consulting_team, graph_input, config)
+        finally:
+            # save_report clears these on success, a failed or cancelled run would keep them forever
+            _finished_nodes.pop(request_id, None)
+            progress_reporter.forget(request_id)
+        await asyncio.to_thread(mark_run, request_id, True)
+        await asyncio.to_thread(compact_run, request_id)
+        await asyncio.to_thread(apply_retention)
+
+    return state
+
+
+async def arun_graph(graph_input):
+
+    state = await arun_graph_state(graph_input)
     report = state["final_report"]
     image_path = state["graph_file_path"]
     impact_value = state["impact_value"]
     return report, image_path, impact_value
+
+def run_graph(graph_input):
+
+    # Blocking entry point for callers without an event loop, like the streamlit app
+    return asyncio.run(arun_graph(graph_input))
+
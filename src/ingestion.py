@@ -0,0 +1,205 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#         Dataset bundle (Parquet + manifest)
+# --------------------------------------------
+
+MAX_INGESTION_WORKERS = int(os.getenv("MAX_INGESTION_WORKERS", "4"))
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+
+
+def _table_name(name, taken):
+
+    base = re.sub(r"[^0-9a-zA-Z_]+", "_", name).strip("_").lower() or "table"
+    table_name = base
+    i = 2
+    while table_name in taken:
+        table_name = f"{base}_{i}"
+        i += 1
+    taken.add(table_name)
+    return table_name
+
+
+def _write_csv_parquet(csv_path, parquet_path, column_types=None):
+
+    # Converted block by block, so memory use is bounded by the block size rather than the file size
+    reader = pa_csv.open_csv(csv_path, read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                             convert_options=pa_csv.ConvertOptions(column_types=column_types or {}))
+    rows = 0
+    with pq.ParquetWriter(parquet_path, reader.schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows, reader.schema.names
+
+
+def csv_to_parquet(csv_path, parquet_path):
+
+    # Types are inferred from the first block only, so a later value that doesn't fit (12.5 in an int column,
+    # text in a numeric one) fails the conversion. The column it names is widened, integers to floats and
+    # anything else to text, and the file converted again
+    column_types = {}
+    schema = None
+    while True:
+        try:
+            return _write_csv_parquet(csv_path, parquet_path, column_types)
+        except pa.ArrowInvalid as e:
+            if schema is None:
+                schema = pa_csv.open_csv(csv_path, read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE)).schema
+            match = re.search(r"CSV column #(\d+)", str(e))
+            field = schema.field(int(match.group(1))) if match and int(match.group(1)) < len(schema) else None
+            if field is None or column_types.get(field.name) == pa.string():
+                # Nothing left to widen, everything goes in as text
+                print(f"Reading {os.path.basename(csv_path)} as text: {e}")
+                return _write_csv_parquet(csv_path, parquet_path, {name: pa.string() for name in schema.names})
+            current = column_types.get(field.name, field.type)
+            column_types[field.name] = pa.float64() if pa.types.is_integer(current) else pa.string()
+            print(f"Column {field.name} of {os.path.basename(csv_path)} changed type after the first block, reading it as {column_types[field.name]}")
+
+
+def dataframe_to_parquet(df, parquet_path):
+
+    # Object columns with mixed types can't be written as is, storing them as text is good enough for analysis
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].astype("string")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, parquet_path, compression="zstd")
+    return table.num_rows, table.schema.names
+
+
+def _convert(job):
+
+    table_name, source, kind, payload, parquet_path = job
+    start = time.perf_counter()
+
+    if kind == "csv":
+        rows, columns = csv_to_parquet(payload, parquet_path)
+    elif kind == "parquet":
+        shutil.copyfile(payload, parquet_path)
+        metadata = pq.read_metadata(parquet_path)
+        rows, columns = metadata.num_rows, metadata.schema.names
+    else:
+        rows, columns = dataframe_to_parquet(payload() if callable(payload) else payload, parquet_path)
+
+    return {
+        "name": table_name,
+        "source": source,
+        "path": parquet_path,
+        "rows": rows,
+        "columns": list(columns),
+        "bytes": os.path.getsize(parquet_path),
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+
+
+def _plan_jobs(file_paths, tables, bundle_dir):
+
+    jobs = []
+    taken = set()
+
+    for file_path in file_paths or []:
+        # Downloads live in randomly named temp files, so callers can pass (original name, path)
+        file_name, file_path = file_path if isinstance(file_path, tuple) else (os.path.basename(file_path), file_path)
+        stem, extension = os.path.splitext(file_name)
+        extension = extension.lower()
+        if extension == ".csv":
+            name = _table_name(stem, taken)
+            jobs.append((name, file_name, "csv", file_path, os.path.join(bundle_dir, f"{name}.parquet")))
+        elif extension == ".parquet":
+            name = _table_name(stem, taken)
+            jobs.append((name, file_name, "parquet", file_path, os.path.join(bundle_dir, f"{name}.parquet")))
+        elif extension == ".xlsx":
+            # Every sheet becomes its own table
+            with pd.ExcelFile(file_path) as workbook:
+                sheet_names = workbook.sheet_names
+            for sheet_name in sheet_names:
+                name = _table_name(f"{stem}_{sheet_name}", taken)
+                load_sheet = lambda file_path=file_path, sheet_name=sheet_name: pd.read_excel(file_path, sheet_name=sheet_name)
+                jobs.append((name, f"{file_name}#{sheet_name}", "dataframe", load_sheet, os.path.join(bundle_dir, f"{name}.parquet")))
+        else:
+            print(f"✗ Skipping unsupported file {file_path}")
+
+    for table, records in (tables or {}).items():
+        name = _table_name(table, taken)
+        load_table = lambda records=records: pd.DataFrame(records)
+        jobs.append((name, f"snapshot:{table}", "dataframe", load_table, os.path.join(bundle_dir, f"{name}.parquet")))
+
+    return jobs
+
+
+def build_dataset_bundle(file_paths=None, tables=None, bundle_dir=None, max_workers=MAX_INGESTION_WORKERS):
+    """
+    Converts every uploaded file (CSV, XLSX sheets, Parquet) and every snapshot table into
+    one Parquet file per table inside bundle_dir, plus a manifest.json describing them.
+
+    Args:
+        file_paths: Local paths of the downloaded files, or (original file name, path) tuples
+        tables: Snapshot tables as {table_name: list of records}
+        bundle_dir: Output directory, a new temp dir if None. The caller is responsible for deleting it.
+        max_workers: Number of tables converted at the same time
+
+    Returns:
+        The manifest dict
+    """
+    bundle_dir = bundle_dir or tempfile.mkdtemp(prefix="bundle_")
+    os.makedirs(bundle_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    jobs = _plan_jobs(file_paths, tables, bundle_dir)
+
+    results = []
+    if jobs:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as executor:
+            futures = [executor.submit(_convert, job) for job in jobs]
+            for job, future in zip(jobs, futures):
+                try:
+                    results.append(future.result())
+                    print(f"✓ Converted {job[1]} to table {job[0]}")
+                except Exception as e:
+                    print(f"✗ Failed to convert {job[1]}: {str(e)}")
+
+    manifest = {
+        "bundle_dir": bundle_dir,
+        "manifest_path": os.path.join(bundle_dir, "manifest.json"),
+        "tables": results,
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+    with open(manifest["manifest_path"], "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Dataset bundle with {len(results)} tables built in {manifest['seconds']}s")
+    return manifest
+
+
+def archive_dataset_bundle(manifest):
+    """Packs the manifest and Parquet files into a single zip so the bundle is uploaded once"""
+
+    archive_path = os.path.join(manifest["bundle_dir"], "dataset_bundle.zip")
+    # Parquet is already compressed, storing avoids paying for compression twice.
+    # Entries get a fixed timestamp and only deterministic manifest fields, so the same
+    # data always produces the same bytes and the upload can be reused across runs
+    with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED) as archive:
+        # Paths inside the archive are relative to wherever it gets extracted
+        archived_tables = [{"name": table["name"], "source": table["source"], "path": os.path.basename(table["path"]),
+                            "rows": table["rows"], "columns": table["columns"]} for table in manifest["tables"]]
+        archive.writestr(zipfile.ZipInfo("manifest.json", ZIP_TIMESTAMP), json.dumps({"tables": archived_tables}, indent=2))
+        for table in manifest["tables"]:
+            with open(table["path"], "rb") as source, archive.open(zipfile.ZipInfo(os.path.basename(table["path"]), ZIP_TIMESTAMP), "w") as target:
+                shutil.copyfileobj(source, target, CSV_BLOCK_SIZE)
+    manifest["archive_path"] = archive_path
+    return archive_path
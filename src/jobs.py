@@ -0,0 +1,320 @@
+import asyncio
+import contextvars
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#        Job queue persisted in SQLite
+# --------------------------------------------
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join("cache", "jobs.sqlite3"))
+# Jobs are coroutines sharing one event loop, so this can be much larger than the number of cores
+MAX_JOB_WORKERS = int(os.getenv("MAX_JOB_WORKERS", "16"))
+# Jobs allowed to wait on top of the ones being worked on before /analyze answers 429
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "20"))
+# A job that was running when the process died is retried at most this many times
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", "2"))
+# Running jobs are leased to the process running them, which renews the lease every JOB_HEARTBEAT_INTERVAL.
+# Other workers sharing the database only take a job back once its lease ran out, i.e. its process is gone
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "10"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# request_id of the job being run in the current thread/task, graph nodes use it to report their timings
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+# request_ids name directories and files on disk, so they can't contain separators or dots
+REQUEST_ID_PATTERN = r"^[A-Za-z0-9_-]{1,64}$"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def check_request_id(request_id):
+
+    if not isinstance(request_id, str) or not re.match(REQUEST_ID_PATTERN, request_id):
+        raise ValueError(f"Invalid request_id: {request_id!r}")
+    return request_id
+
+
+class JobScheduler:
+
+    def __init__(self, handler, db_path=JOBS_DB_PATH, max_workers=MAX_JOB_WORKERS, max_queued=MAX_QUEUED_JOBS,
+                 max_attempts=MAX_JOB_ATTEMPTS, lease_seconds=JOB_LEASE_SECONDS, heartbeat_interval=JOB_HEARTBEAT_INTERVAL):
+
+        self.handler = handler
+        self.db_path = db_path
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        # Unique per scheduler, a restarted process with the same pid doesn't pass for the old one
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stopping = threading.Event()
+        self._loop = None
+        self._wakeup = None
+        self._thread = None
+        self._heartbeat_thread = None
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _init_db(self):
+
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    request_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    node_timings TEXT NOT NULL DEFAULT '{}',
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    owner TEXT,
+                    heartbeat_at REAL
+                )""")
+            # Databases created before jobs were leased
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (("owner", "TEXT"), ("heartbeat_at", "REAL")):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+
+    def start(self):
+
+        self._recover()
+
+        # Every job runs on one event loop in its own thread, away from the server's loop,
+        # so a node that blocks by mistake can't stall /health
+        self._stopping.clear()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_until_complete, args=(self._run_workers(),),
+                                        name="job-scheduler", daemon=True)
+        self._thread.start()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop(self, timeout=5):
+
+        self._stopping.set()
+        self._notify()
+        for thread in (self._thread, self._heartbeat_thread):
+            if thread is not None:
+                thread.join(timeout)
+        self._thread = None
+        self._heartbeat_thread = None
+
+    def _recover(self):
+
+        # Jobs whose process stopped renewing their lease, i.e. died or was restarted, go back in the queue.
+        # Ones still leased belong to another worker sharing the database and are left alone
+        now = time.time()
+        expired = "state = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)"
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(f"UPDATE jobs SET state = ?, error = 'Attempts exhausted after restart', finished_at = ?, owner = NULL WHERE {expired} AND attempts >= ?",
+                                   (FAILED, now, RUNNING, now - self.lease_seconds, self.max_attempts))
+                recovered = connection.execute(f"UPDATE jobs SET state = ?, owner = NULL WHERE {expired}",
+                                               (QUEUED, RUNNING, now - self.lease_seconds)).rowcount
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        if recovered:
+            print(f"Recovered {recovered} interrupted jobs")
+            self._notify()
+
+    def _heartbeat(self):
+
+        # Its own thread, so a job blocking the scheduler's loop for a while doesn't lose its lease
+        while not self._stopping.wait(self.heartbeat_interval):
+            try:
+                with self._connect() as connection:
+                    connection.execute("UPDATE jobs SET heartbeat_at = ? WHERE state = ? AND owner = ?",
+                                       (time.time(), RUNNING, self.owner))
+                self._recover()
+            except sqlite3.Error as e:
+                print(f"✗ Job heartbeat failed: {str(e)}")
+
+    def _notify(self):
+
+        if self._loop is not None and self._wakeup is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def submit(self, request_id, payload):
+        """Queues a job, or returns the existing one if that request_id is already queued or running"""
+
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                existing = connection.execute("SELECT state FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+                if existing and existing["state"] in (QUEUED, RUNNING):
+                    connection.execute("COMMIT")
+                    return self.get(request_id)
+
+                active = connection.execute("SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)", (QUEUED, RUNNING)).fetchone()[0]
+                if active >= self.max_workers + self.max_queued:
+                    raise QueueFullError(f"{active} jobs already queued or running")
+
+                connection.execute(
+                    "INSERT OR REPLACE INTO jobs (request_id, state, payload, attempts, node_timings, created_at) VALUES (?, ?, ?, 0, '{}', ?)",
+                    (request_id, QUEUED, json.dumps(payload), time.time()))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        self._notify()
+        return self.get(request_id)
+
+    def requeue(self, request_id):
+        """Puts a finished or failed job back in the queue with its original payload"""
+
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                existing = connection.execute("SELECT state FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+                if existing is None:
+                    connection.execute("COMMIT")
+                    return None
+                if existing["state"] not in (QUEUED, RUNNING):
+                    active = connection.execute("SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)", (QUEUED, RUNNING)).fetchone()[0]
+                    if active >= self.max_workers + self.max_queued:
+                        raise QueueFullError(f"{active} jobs already queued or running")
+                    # A manual resume gets a fresh set of attempts
+                    connection.execute("UPDATE jobs SET state = ?, attempts = 0, error = NULL, created_at = ?, started_at = NULL, finished_at = NULL WHERE request_id = ?",
+                                       (QUEUED, time.time(), request_id))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        self._notify()
+        return self.get(request_id)
+
+    def get(self, request_id):
+
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            job.pop("payload")
+            job["node_timings"] = json.loads(job["node_timings"])
+            if job["started_at"]:
+                job["queue_seconds"] = round(job["started_at"] - job["created_at"], 3)
+            if job["state"] == QUEUED:
+                job["queue_position"] = connection.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE state = ? AND created_at <= ?", (QUEUED, job["created_at"])).fetchone()[0]
+        return job
+
+    def stats(self):
+
+        with self._connect() as connection:
+            rows = connection.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+        counts = {row["state"]: row["n"] for row in rows}
+        return {"workers": self.max_workers, "max_queued": self.max_queued, **counts}
+
+    def record_node_timing(self, request_id, node, seconds):
+
+        # json_set keeps concurrent nodes of the same job from overwriting each other
+        with self._connect() as connection:
+            connection.execute("UPDATE jobs SET node_timings = json_set(node_timings, ?, ?) WHERE request_id = ?",
+                               (f'$."{node}"', round(seconds, 3), request_id))
+
+    def _claim(self):
+
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT request_id, payload FROM jobs WHERE state = ? ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            now = time.time()
+            connection.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ?, owner = ?, heartbeat_at = ? WHERE request_id = ?",
+                               (RUNNING, now, self.owner, now, row["request_id"]))
+            connection.execute("COMMIT")
+        return row["request_id"], json.loads(row["payload"])
+
+    def _finish(self, request_id, state, error=None):
+
+        with self._connect() as connection:
+            # A job this process lost the lease on is someone else's now
+            connection.execute("UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE request_id = ? AND owner = ?",
+                               (state, error, time.time(), request_id, self.owner))
+
+    async def _run_workers(self):
+
+        self._wakeup = asyncio.Event()
+        await asyncio.gather(*[self._work() for _ in range(self.max_workers)])
+
+    async def _work(self):
+
+        while not self._stopping.is_set():
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            request_id, payload = job
+            token = current_job.set(request_id)
+            try:
+                await self.handler(payload)
+                await asyncio.to_thread(self._finish, request_id, SUCCEEDED)
+            except Exception as e:
+                traceback.print_exc()
+                await asyncio.to_thread(self._finish, request_id, FAILED, str(e))
+            finally:
+                current_job.reset(token)
+
+
+_scheduler = None
+
+
+def set_scheduler(scheduler):
+
+    global _scheduler
+    _scheduler = scheduler
+
+
+def record_node_timing(node, seconds):
+
+    request_id = current_job.get()
+    if _scheduler is not None and request_id is not None:
+        _scheduler.record_node_timing(request_id, node, seconds)
@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#        LLM response cache in SQLite
+# --------------------------------------------
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join("cache", "llm_cache.sqlite3"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(100 * 1024 ** 2)))
+# Set to skip the cache everywhere, both for reads and writes
+LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "").lower() in ("1", "true", "yes")
+
+_counters = {"hits": 0, "misses": 0, "bypassed": 0}
+_counters_lock = threading.Lock()
+_initialized = set()
+
+
+@contextmanager
+def _connect(db_path=None):
+
+    db_path = db_path or LLM_CACHE_PATH
+    if db_path not in _initialized:
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        if db_path not in _initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used_at)")
+            _initialized.add(db_path)
+        yield connection
+    finally:
+        connection.close()
+
+
+def normalize_prompt(prompt):
+
+    # The prompts are built from indented multi-line strings, whitespace differences shouldn't miss the cache
+    if isinstance(prompt, (list, tuple)):
+        return "\n".join(normalize_prompt(part) for part in prompt)
+    return " ".join(str(prompt).split())
+
+
+def make_key(model, prompt, schema=None):
+
+    payload = json.dumps({"model": model, "prompt": normalize_prompt(prompt), "schema": schema}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _count(counter):
+
+    with _counters_lock:
+        _counters[counter] += 1
+
+
+def get_cached(key, ttl=None, db_path=None):
+
+    ttl = LLM_CACHE_TTL if ttl is None else ttl
+    now = time.time()
+    with _connect(db_path) as connection:
+        row = connection.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        if now - created_at > ttl:
+            connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            return None
+        connection.execute("UPDATE llm_cache SET last_used_at = ? WHERE key = ?", (now, key))
+    return value
+
+
+def put_cached(key, model, value, max_bytes=None, db_path=None):
+
+    max_bytes = LLM_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time()
+    size = len(value.encode())
+    with _connect(db_path) as connection:
+        connection.execute("INSERT OR REPLACE INTO llm_cache (key, model, value, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, model, value, size, now, now))
+        evict(connection, max_bytes)
+
+
+def evict(connection, max_bytes):
+
+    connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - LLM_CACHE_TTL,))
+    total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+    if total <= max_bytes:
+        return
+    # Least recently used entries go first, until the cache is back under its size budget
+    for key, size in connection.execute("SELECT key, size FROM llm_cache ORDER BY last_used_at").fetchall():
+        if total <= max_bytes:
+            break
+        connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+        total -= size
+
+
+async def cached_llm_call(model, prompt, call, schema=None, bypass=False):
+    """
+    Returns the cached text for (model, prompt, schema) or awaits call() and caches its result.
+
+    Args:
+        model: Model name, part of the key
+        prompt: Prompt text, or a list of message texts
+        call: Coroutine function returning the response text
+        schema: Optional JSON schema of a structured output, part of the key
+        bypass: Skip the cache for this call
+    """
+    if bypass or LLM_CACHE_BYPASS:
+        _count("bypassed")
+        return await call()
+
+    key = make_key(model, prompt, schema)
+    # SQLite is blocking and writers wait on each other, it stays off the event loop the jobs share
+    try:
+        value = await asyncio.to_thread(get_cached, key)
+    except sqlite3.Error as e:
+        print(f"LLM cache read failed: {e}")
+        value = None
+
+    if value is not None:
+        _count("hits")
+        return value
+
+    _count("misses")
+    value = await call()
+    try:
+        await asyncio.to_thread(put_cached, key, model, value)
+    except sqlite3.Error as e:
+        print(f"LLM cache write failed: {e}")
+    return value
+
+
+def cache_stats(db_path=None):
+
+    with _counters_lock:
+        stats = dict(_counters)
+    with _connect(db_path) as connection:
+        entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+    stats.update({"entries": entries, "bytes": size})
+    return stats
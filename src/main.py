@@ -1,25 +1,68 @@
-from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, Form, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response, PlainTextResponse
+from pydantic import BaseModel, Field
 from typing import List, Optional
-import uvicorn
 import tempfile
-import base64
 import os
+import shutil
+import sys
+import threading
 import asyncio
-import pandas as pd
 import json
 from fastapi.concurrency import run_in_threadpool
-from src.graph import run_graph
-from src.s3_retrieval import get_client_snapshot
-from src.supabase_functions import download_and_process_files, save_report_in_supabase
+from src.checkpoints import get_bundle_dir, get_response_path, apply_retention, RESPONSES_DIR
+from src.artifacts import get_artifact_dir, get_stored_artifact
+from src.events import publish, close, subscribe, has_events
+from src.jobs import JobScheduler, QueueFullError, set_scheduler, REQUEST_ID_PATTERN, QUEUED, RUNNING, SUCCEEDED, FAILED
+from src.llm_cache import cache_stats
+from src.result_store import (claim, content_key, fail_run, get_result, get_run, save_result, DEDUP_ENABLED, DEDUP_POLL_INTERVAL,
+                              LEADER, COMPLETED, RUNNING as RESULT_RUNNING, SUCCEEDED as RESULT_SUCCEEDED)
+from src.telemetry import observe, get_breakdown, render_metrics, count
 from dotenv import load_dotenv
-from typing import Optional
 import traceback
+from contextlib import asynccontextmanager
 
 load_dotenv()
 
-app = FastAPI(title="Profit Oracle API", description="API for processing analysis requests")
+async def run_analysis_job(payload):
+
+    job = await asyncio.to_thread(app.state.scheduler.get, payload["request_id"])
+    if job and job.get("queue_seconds") is not None:
+        observe("queue", "job", job["queue_seconds"])
+    await run_analysis(AnalysisRequest(**payload))
+
+
+def warm_up():
+
+    # The graph, the agents and their SDKs (pandas, langchain, openai...) are imported here in the
+    # background instead of at import time, so a cold worker answers /health right away
+    try:
+        from src.graph import get_graph
+        import src.ingestion
+        import src.supabase_functions
+        get_graph()
+    except Exception:
+        traceback.print_exc()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+
+    await run_in_threadpool(apply_retention, True)
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    scheduler = JobScheduler(run_analysis_job)
+    set_scheduler(scheduler)
+    scheduler.start()
+    app.state.scheduler = scheduler
+    yield
+    scheduler.stop()
+    # Pending progress writes go out before the process exits
+    supabase_functions = sys.modules.get("src.supabase_functions")
+    if supabase_functions is not None:
+        supabase_functions.progress_reporter.stop()
+
+
+app = FastAPI(title="Profit Oracle API", description="API for processing analysis requests", lifespan=lifespan)
 
 def save_data_file(file_content, file_name):
 
@@ -30,90 +73,179 @@ def save_data_file(file_content, file_name):
 
     return temp_path
 
-def run_analysis(data, client_name=None, snapshot_idx=None):
+def save_response(request_id, result):
+
+    os.makedirs(RESPONSES_DIR, exist_ok=True)
+    with open(get_response_path(request_id), "w") as json_file:
+        json.dump(result, json_file)
+
+
+def is_job_active(request_id):
+
+    job = app.state.scheduler.get(request_id)
+    return job is not None and job["state"] in (QUEUED, RUNNING)
+
+
+async def wait_for_duplicate(request_id, key):
+    """
+    Returns the result of an identical request that finished recently, or waits for one that is
+    still running. Returns None when there's no such request and this one runs the pipeline.
+    """
+    attached = False
+    while True:
+        role, value = await asyncio.to_thread(claim, request_id, key, is_job_active)
+        if role == LEADER:
+            return None
+        if role == COMPLETED:
+            return value
+
+        if not attached:
+            print(f"{request_id} is identical to a request in progress, waiting for its result")
+            publish(request_id, "run_deduplicated")
+            attached = True
+        while True:
+            await asyncio.sleep(DEDUP_POLL_INTERVAL)
+            state, result = await asyncio.to_thread(get_run, value)
+            if state == RESULT_SUCCEEDED:
+                return result
+            # The other request failed or its job is gone, claim again, this one may have to run it
+            if state != RESULT_RUNNING or not await asyncio.to_thread(is_job_active, value):
+                break
+
+
+async def run_analysis(data, client_name=None, snapshot_idx=None):
+
+    # Imported on first use (and ahead of it by warm_up), they bring in every heavy dependency
+    from src.graph import arun_graph_state, get_resumable_nodes
+    from src.ingestion import build_dataset_bundle
+    from src.s3_retrieval import get_client_snapshot
+    from src.supabase_functions import download_and_process_files, save_report_in_supabase
 
     # Placeholder for the actual analysis logic
+    request_id = None
     temp_path = None
+    file_path_list = []
+    named_file_paths = []
+    snapshot_tables = None
+    manifest = None
+    bundle_dir = None
+    dedup_key = None
+    state = None
+    succeeded = False
     try:
+        resumable_nodes = ()
         if data is not None:
             # Read file content
             request_id = data.request_id
+            publish(request_id, "run_started")
             goal = data.goal
             business_profile = data.business_profile
             file_urls = data.file_urls
             print(f"Goal: {goal}, Business Profile: {business_profile}, File URLs: {file_urls}")
-            processed_files = download_and_process_files(file_urls)
-            file_path_list = []
+            # The bundle lives under the request_id so a failed run can be resumed with the same tables
+            bundle_dir = get_bundle_dir(request_id)
+            resumable_nodes = await get_resumable_nodes(request_id)
+
+        manifest_path = os.path.join(bundle_dir, "manifest.json") if bundle_dir else None
+        if resumable_nodes and os.path.exists(manifest_path):
+            print(f"Resuming {request_id}, reusing its data bundle")
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        elif data is not None:
+            # Files are streamed straight to temp files, so there's nothing left to copy here
+            processed_files = await asyncio.to_thread(download_and_process_files, file_urls)
             for file_info in processed_files:
-                file_name = file_info["filename"]
-                file_bytes = file_info["content"] if file_info["content"] else b""
-                temp_path =  save_data_file(file_bytes, file_name)
+                if file_info["error"]:
+                    continue
+                temp_path = file_info["path"]
                 file_path_list.append(temp_path)
-        elif client_name and snapshot_idx:
-            snapshot = get_client_snapshot(client_name, snapshot_idx)
-            for table in snapshot.get("tables", []):
-                table_content = snapshot["tables"][table]
-                df = pd.DataFrame(table_content)
-                file_path = f"{table}.csv"
-                df.to_csv(file_path, index=False)
-                file_path_list.append(file_path)
-
-        graph_input = {"goal":goal,
-                "business_profile":business_profile,
-                "data_path":temp_path}
+                named_file_paths.append((file_info["filename"], temp_path))
 
-        report, image_path, impact_value = run_graph(graph_input)
-        print("Graph done")
+            # Identical goal, profile and files as a recent or running request: its result is copied instead of running again
+            if DEDUP_ENABLED and not data.bypass_llm_cache:
+                dedup_key = content_key(goal, business_profile, [file_info["sha256"] for file_info in processed_files if not file_info["error"]])
+                result = await wait_for_duplicate(request_id, dedup_key)
+                if result is not None:
+                    print(f"Serving {request_id} with the result of an identical request")
+                    await asyncio.to_thread(save_report_in_supabase, request_id, result["report"], result["impact_value"],
+                                            result.get("confidence_percentage"), result.get("payback_months"))
+                    await asyncio.to_thread(save_response, request_id, result)
+                    await asyncio.to_thread(save_result, request_id, result, dedup_key)
+                    count("deduplicated_requests_total", kind="content")
+                    succeeded = True
+                    publish(request_id, "run_finished", impact_value=result["impact_value"])
+                    return
+        elif client_name and snapshot_idx:
+            snapshot = await asyncio.to_thread(get_client_snapshot, client_name, snapshot_idx)
+            if isinstance(snapshot, str):
+                snapshot = json.loads(snapshot)
+            snapshot_tables = snapshot.get("tables", {})
 
-        # Save report in Supabase
-        if request_id:
-            save_report_in_supabase(request_id, report, impact_value)
-        # Read and encode the image file as base64
-        responses_dir = "responses"
-        os.makedirs(responses_dir, exist_ok=True)
-        try:
-            with open(image_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
-            # Get image file extension for proper MIME type
-            image_ext = image_path.split(".")[-1].lower()
-            mime_type = f"image/{image_ext}" if image_ext in ['png', 'jpg', 'jpeg', 'gif', 'svg'] else "image/png"
-
-            result = {
-            "report": report,
-            "impact_value": impact_value,
-            "image": {
-                "data": image_data,
-                "mime_type": mime_type,
-                "filename": os.path.basename(image_path)
-            },
-            "status": "success"
-            }
+        if manifest is None:
+            if bundle_dir:
+                shutil.rmtree(bundle_dir, ignore_errors=True)
+            # Every file and snapshot table ends up as a Parquet table in one bundle for the agents
+            manifest = await asyncio.to_thread(build_dataset_bundle, file_paths=named_file_paths, tables=snapshot_tables, bundle_dir=bundle_dir)
 
-            with open(os.path.join(responses_dir, f"{request_id}_response.json"), "w") as json_file:
-                json.dump(result, json_file)
+        graph_input = {"request_id":request_id,
+                "goal":goal,
+                "business_profile":business_profile,
+                "data_path":temp_path,
+                "dataset_manifest":manifest,
+                "bypass_llm_cache":bool(data is not None and data.bypass_llm_cache)}
 
-            print("JSON response built and saved locally")
+        # The report is saved in Supabase by the last node of the graph
+        state = await arun_graph_state(graph_input)
+        print("Graph done")
+        succeeded = True
+        publish(request_id, "run_finished", impact_value=state["impact_value"])
 
-        except Exception as e:
-            traceback.print_exc()
-            result = {
-            "report": report,
-            "impact_value": impact_value,
+        # Files are referenced by their id in the artifact store and downloaded from /artifacts/{id}
+        artifacts = [{key: artifact[key] for key in ("id", "url", "filename", "kind", "content_type", "bytes") if key in artifact}
+                     for artifact in state.get("artifacts") or []]
+        images = [artifact for artifact in artifacts if artifact["kind"] == "image" and "id" in artifact]
+        result = {
+            "report": state["final_report"],
+            "impact_value": state["impact_value"],
+            "confidence_percentage": state.get("confidence_percentage"),
+            "payback_months": state.get("payback_months"),
+            "image": images[0] if images else None,
+            "artifacts": artifacts,
             "status": "success"
-            }
-            with open(os.path.join(responses_dir, f"{request_id}_response.json"), "w") as json_file:
-                json.dump(result, json_file)
+        }
+        save_response(request_id, result)
+        if request_id:
+            # Served to retries of this request_id and to identical requests for RESULT_TTL
+            await asyncio.to_thread(save_result, request_id, result, dedup_key)
+        print("JSON response built and saved locally")
 
     except Exception as e:
         print(f"Failed to process request: {str(e)}")
         traceback.print_exc()
+        publish(request_id, "run_failed", error=str(e))
+        if request_id:
+            await asyncio.to_thread(fail_run, request_id)
+        # Let the job scheduler mark the job as failed
+        raise
     finally:
-        # Clean up temporary file
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
+        close(request_id)
+        # Clean up temporary files
+        for path in file_path_list:
+            if path and os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except:
+                    pass
+        # Failed runs keep their bundle for a resume, it's removed with their checkpoints eventually
+        if manifest and (succeeded or not bundle_dir):
+            shutil.rmtree(manifest["bundle_dir"], ignore_errors=True)
+        if succeeded and request_id:
+            shutil.rmtree(get_artifact_dir(request_id), ignore_errors=True)
+        elif state and not request_id:
+            # Runs without a request_id got a run_<uuid> directory, only the content-addressed copies are kept
+            for artifact_dir in {os.path.dirname(artifact["path"]) for artifact in state.get("artifacts") or []}:
+                if os.path.basename(artifact_dir).startswith("run_"):
+                    shutil.rmtree(artifact_dir, ignore_errors=True)
 
 """
 Old code:
@@ -136,28 +268,121 @@ goal: str = Form(..., description="The goal/objective of the data analysis proce
 
 
 class AnalysisRequest(BaseModel):
-    request_id: str
+    # Anything else is rejected with a 422, the id names the run's files on disk
+    request_id: str = Field(pattern=REQUEST_ID_PATTERN)
     goal: str
     business_profile: str
     file_urls: Optional[List[str]] = []
+    bypass_llm_cache: Optional[bool] = False
 
 
 @app.post("/analyze")
-async def analyze_data(data: AnalysisRequest, background_tasks: BackgroundTasks):
-    background_tasks.add_task(run_analysis, data)
-    return JSONResponse(content={"message": "Processing"}, status_code=200)
-    
-    
-    
+async def analyze_data(data: AnalysisRequest):
+    # A retry of a request that already finished gets its stored result, one still in progress gets its job back
+    if DEDUP_ENABLED and not data.bypass_llm_cache:
+        result = await run_in_threadpool(get_result, data.request_id)
+        if result is not None:
+            count("deduplicated_requests_total", kind="request_id")
+            return JSONResponse(content={"message": "Completed", "request_id": data.request_id, "state": SUCCEEDED, "result": result},
+                                status_code=200)
+    try:
+        job = await run_in_threadpool(app.state.scheduler.submit, data.request_id, data.model_dump())
+    except QueueFullError as e:
+        return JSONResponse(content={"message": "Too many requests in progress, try again later", "detail": str(e)},
+                            status_code=429, headers={"Retry-After": "60"})
+    return JSONResponse(content={"message": "Processing", "request_id": data.request_id, "state": job["state"]}, status_code=200)
+
+
+def sse_event(event_type, data):
+
+    return f"event: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@app.get("/analyze/{request_id}/events")
+async def analysis_events(request_id: str):
+    """Server-sent events of a request: its job state first, then node starts and finishes and the report as it's written"""
+    job = await run_in_threadpool(app.state.scheduler.get, request_id)
+    if job is None and not has_events(request_id):
+        raise HTTPException(status_code=404, detail=f"No job found for request {request_id}")
+
+    async def event_stream():
+        yield sse_event("job", job)
+        # Finished long enough ago that its events are gone, the job state is all there is
+        if job is not None and job["state"] in (SUCCEEDED, FAILED) and not has_events(request_id):
+            return
+        async for event in subscribe(request_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield sse_event(event["type"], event)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/jobs/{request_id}")
+async def get_job(request_id: str):
+    job = await run_in_threadpool(app.state.scheduler.get, request_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job found for request {request_id}")
+    # Time, tokens and cost per node and per OpenAI, S3 and Supabase call, while this process remembers them
+    job["breakdown"] = get_breakdown(request_id)
+    return job
+
+
+@app.post("/jobs/{request_id}/resume")
+async def resume_job(request_id: str):
+    # The run continues from its last checkpoint, nodes that already finished aren't run again
+    try:
+        job = await run_in_threadpool(app.state.scheduler.requeue, request_id)
+    except QueueFullError as e:
+        return JSONResponse(content={"message": "Too many requests in progress, try again later", "detail": str(e)},
+                            status_code=429, headers={"Retry-After": "60"})
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job found for request {request_id}")
+    return job
+
+@app.get("/artifacts/{artifact_id}")
+async def get_artifact(artifact_id: str, request: Request):
+    stored = await run_in_threadpool(get_stored_artifact, artifact_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"No artifact {artifact_id}")
+    path, metadata = stored
+
+    # The id is the content hash, so the ETag never changes and the file can be cached forever
+    headers = {"ETag": f'"{artifact_id}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if f'"{artifact_id}"' in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    # FileResponse streams the file in chunks and answers Range requests with 206
+    return FileResponse(path, media_type=metadata["content_type"], filename=metadata["filename"],
+                        content_disposition_type="inline", headers=headers)
 
 @app.post("/retrieve_s3")
 async def retreive_s3(
     client:str = Form(..., description="Client ID used in the sync app to upload the data"), 
     idx:int = Form(..., description="The index of the snapshot of the data you want. Use -1 for the last one, -2 for second to last, 0 for the first one, 1 for the second, etc.")):
 
+    from src.s3_retrieval import get_client_snapshot
     snapshot = await run_in_threadpool(get_client_snapshot, client, idx)
     return {"snapshot": snapshot}
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    stats = await run_in_threadpool(app.state.scheduler.stats)
+    llm_cache = await run_in_threadpool(cache_stats)
+    gauges = {
+        "jobs": {(("state", state),): count for state, count in stats.items() if state not in ("workers", "max_queued")},
+        "job_workers": {(): stats["workers"]},
+        "llm_cache_requests": {(("result", result),): llm_cache.get(result, 0) for result in ("hits", "misses", "bypassed")},
+        "llm_cache_bytes": {(): llm_cache["bytes"]},
+    }
+    # Loaded with the first job's OpenAI client, there's no queue to report before that
+    openai_scheduler = sys.modules.get("src.openai_scheduler")
+    if openai_scheduler:
+        gauges.update(openai_scheduler.openai_scheduler.get_gauges())
+    return PlainTextResponse(render_metrics(gauges), media_type="text/plain; version=0.0.4")
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -169,5 +394,6 @@ async def health_check():
     return {"status": "healthy"}
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5000)
 
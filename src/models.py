@@ -13,13 +13,22 @@ class ManagerCommand(BaseModel):
     research_instructions: Instructions = Field(description="The tasks, standards and focus for the research agent")
     analytics_instructions: Instructions = Field(description="The tasks, standards and focus for the analytics agent")
 
+class SynthesizerReport(BaseModel):
+    report: str = Field(description="The full report for the client, ready to be printed")
+    impact_value: float = Field(description="Estimated monthly financial impact in USD of implementing the report's action items")
+    confidence_percentage: float = Field(description="Confidence in the impact estimate, from 0 to 100")
+    payback_months: float = Field(description="Estimated months until the action items pay back their cost")
+
 # States for the graph and nodes
 # ------------------------------------------
 
 class State(TypedDict):
+    request_id: str
     goal: str
     business_profile: str
     data_path: str
+    dataset_manifest: dict
+    bypass_llm_cache: bool
     research_instructions: Instructions
     analytics_instructions: Instructions
     qa_research_report: str
@@ -27,21 +36,28 @@ class State(TypedDict):
     research_report: str
     analytics_report: str
     graph_file_path: str
+    artifacts: list
     impact_value: str
+    confidence_percentage: float
+    payback_months: float
     final_report: str
 
 # This subclasses are useful for testing each agent individually:
 
 class ResearchState(TypedDict):
+    request_id: str
     research_instructions: Instructions
+    bypass_llm_cache: bool
 
 class AnalyticsState(TypedDict):
     analytics_instructions: Instructions
     data_path: str
+    dataset_manifest: dict
 
 class SynthersizerState(TypedDict):
     business_profile: str
     goal: str
     research_report: str
     analytics_report: str
-    graph_file_path: str
\ No newline at end of file
+    graph_file_path: str
+    artifacts: list
\ No newline at end of file
@@ -0,0 +1,375 @@
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import httpx
+from src.telemetry import observe, record_retry
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#    Process-wide scheduler for OpenAI calls
+# --------------------------------------------
+# Every OpenAI request of every job waits in one queue per process. Each model has token buckets
+# for its requests and tokens per minute, and a cap limits the requests in flight. A 429 pauses
+# the whole model with a jittered backoff, instead of every job retrying into the limit on its own.
+
+# Requests and tokens per minute per model, e.g. '{"o3-deep-research": [50, 200000]}'. Models not
+# listed aren't throttled until their first response, their limits then come from its x-ratelimit-* headers
+OPENAI_RATE_LIMITS = {model: tuple(limits) for model, limits in json.loads(os.getenv("OPENAI_RATE_LIMITS", "{}")).items()}
+# Requests waiting on their response headers at the same time, over all models
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+# The scheduler does the retrying, the SDK clients are created with max_retries=0
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "1"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "60"))
+
+# Lower goes first: the manager, the estimator, polls and uploads don't wait behind analytics or deep research
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+LOW_PRIORITY_MODELS = ("o3-deep-research", "o4-mini-deep-research")
+
+_priority = ContextVar("openai_priority", default=None)
+
+
+@contextmanager
+def openai_priority(priority):
+    """OpenAI calls made inside this block queue with the given priority"""
+
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Exponential backoff with jitter, never shorter than what the server asked for"""
+
+    delay = min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay)
+    return max(delay, retry_after) if retry_after is not None else delay
+
+
+def _int_header(headers, name):
+
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class _Bucket:
+    """Refills to capacity over a minute; a capacity of None means no limit is known yet"""
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+
+        if self.capacity is None:
+            return 0
+        # A call bigger than the whole bucket would wait forever, it waits for a full bucket instead
+        return max(0, (min(amount, self.capacity) - self.level) * 60 / self.capacity)
+
+    def take(self, amount):
+
+        if self.capacity is not None:
+            self.level -= min(amount, self.capacity)
+
+    def sync(self, limit, remaining, now):
+
+        self.refill(now)
+        if limit:
+            if self.capacity is None:
+                self.level = limit
+            self.capacity = limit
+        if remaining is not None and self.capacity is not None:
+            # The server's count includes other processes using the same key
+            self.level = min(remaining, self.capacity)
+
+
+class _ModelLimits:
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = _Bucket(requests_per_minute)
+        self.tokens = _Bucket(tokens_per_minute)
+        self.paused_until = 0.0
+
+
+class _Ticket:
+
+    def __init__(self, rank, model, tokens):
+        self.rank = rank
+        self.model = model
+        self.tokens = tokens
+        self.granted = False
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+
+class OpenAIScheduler:
+    """
+    Hands out the right to send an OpenAI request, best priority first.
+
+    Jobs run on the job scheduler's loop, the streamlit app on its own, so the state is
+    guarded by a plain lock and waiters are woken through their loop's call_soon_threadsafe.
+    """
+
+    def __init__(self, max_concurrency=OPENAI_MAX_CONCURRENCY, rate_limits=None):
+        self.max_concurrency = max_concurrency
+        self.rate_limits = OPENAI_RATE_LIMITS if rate_limits is None else rate_limits
+        self._lock = threading.Lock()
+        self._models = {}
+        self._waiting = []
+        self._in_flight = 0
+        self._sequence = itertools.count()
+
+    def _limits(self, model):
+
+        limits = self._models.get(model)
+        if limits is None:
+            limits = self._models[model] = _ModelLimits(*self.rate_limits.get(model, (None, None)))
+        return limits
+
+    def _wait_time(self, ticket, now):
+
+        limits = self._limits(ticket.model)
+        limits.requests.refill(now)
+        limits.tokens.refill(now)
+        return max(limits.paused_until - now, limits.requests.wait_time(1), limits.tokens.wait_time(ticket.tokens), 0)
+
+    def _grant(self):
+        """Gives free slots to the best ranked waiters their model's limits allow, returns the ones to wake"""
+
+        now = time.monotonic()
+        granted = []
+        blocked_models = set()
+        for ticket in list(self._waiting):
+            if self._in_flight >= self.max_concurrency:
+                break
+            if ticket.model in blocked_models:
+                continue
+            if self._wait_time(ticket, now) > 0:
+                # Later calls to the same model don't overtake it, other models still go
+                blocked_models.add(ticket.model)
+                continue
+            limits = self._limits(ticket.model)
+            limits.requests.take(1)
+            limits.tokens.take(ticket.tokens)
+            self._waiting.remove(ticket)
+            self._in_flight += 1
+            ticket.granted = True
+            granted.append(ticket)
+        return granted
+
+    def _wake(self, tickets):
+
+        for ticket in tickets:
+            if not ticket.loop.is_closed():
+                ticket.loop.call_soon_threadsafe(ticket.event.set)
+
+    async def acquire(self, model, tokens=0, priority=PRIORITY_HIGH, sequence=None):
+        """
+        Waits until a request to model may be sent and returns its ticket; release() must follow.
+        A retry passes its first ticket's sequence to keep its place in the queue.
+        """
+        start = time.monotonic()
+        sequence = next(self._sequence) if sequence is None else sequence
+        ticket = _Ticket((priority, sequence), model, tokens)
+        with self._lock:
+            bisect.insort(self._waiting, ticket, key=lambda waiting: waiting.rank)
+            granted = self._grant()
+        self._wake(granted)
+
+        try:
+            while not ticket.granted:
+                with self._lock:
+                    # Woken early by a release, otherwise re-checked once the model's buckets should have refilled
+                    timeout = min(max(self._wait_time(ticket, time.monotonic()), 0.01), 1.0)
+                try:
+                    await asyncio.wait_for(ticket.event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        granted = self._grant()
+                    self._wake(granted)
+        except BaseException:
+            with self._lock:
+                if ticket.granted:
+                    self._in_flight -= 1
+                else:
+                    self._waiting.remove(ticket)
+                granted = self._grant()
+            self._wake(granted)
+            raise
+
+        observe("queue", f"openai:{model or 'none'}", time.monotonic() - start)
+        return ticket
+
+    def release(self):
+
+        with self._lock:
+            self._in_flight -= 1
+            granted = self._grant()
+        self._wake(granted)
+
+    def pause(self, model, seconds):
+        """Holds every request to model for the given time, e.g. after a 429"""
+
+        with self._lock:
+            limits = self._limits(model)
+            limits.paused_until = max(limits.paused_until, time.monotonic() + seconds)
+
+    def consume(self, model, tokens):
+        """Charges tokens used outside of a request's own response, like a background run's"""
+
+        with self._lock:
+            limits = self._limits(model)
+            limits.tokens.refill(time.monotonic())
+            limits.tokens.take(tokens)
+
+    def update_limits(self, model, headers):
+        """Syncs the model's buckets with the x-ratelimit-* headers of a response"""
+
+        if not model or "x-ratelimit-limit-requests" not in headers and "x-ratelimit-limit-tokens" not in headers:
+            return
+        now = time.monotonic()
+        with self._lock:
+            limits = self._limits(model)
+            limits.requests.sync(_int_header(headers, "x-ratelimit-limit-requests"), _int_header(headers, "x-ratelimit-remaining-requests"), now)
+            limits.tokens.sync(_int_header(headers, "x-ratelimit-limit-tokens"), _int_header(headers, "x-ratelimit-remaining-tokens"), now)
+
+    def get_gauges(self):
+        """Queue depth, requests in flight and the known remaining limits, for /metrics"""
+
+        with self._lock:
+            now = time.monotonic()
+            depth = {}
+            for ticket in self._waiting:
+                labels = (("model", ticket.model or "none"), ("priority", PRIORITY_NAMES.get(ticket.rank[0], str(ticket.rank[0]))))
+                depth[labels] = depth.get(labels, 0) + 1
+            remaining = {}
+            for model, limits in self._models.items():
+                for limit_type, bucket in (("requests", limits.requests), ("tokens", limits.tokens)):
+                    if model and bucket.capacity is not None:
+                        bucket.refill(now)
+                        remaining[(("model", model), ("type", limit_type))] = max(int(bucket.level), 0)
+            return {
+                "openai_queue_depth": depth,
+                "openai_in_flight": {(): self._in_flight},
+                "openai_rate_limit_remaining": remaining,
+            }
+
+
+openai_scheduler = OpenAIScheduler()
+
+
+# --------------------------------------------
+#       httpx transport for the clients
+# --------------------------------------------
+
+def _describe(request):
+    """The model of a request and a rough count of the tokens it will use, for the token bucket"""
+
+    if "json" not in request.headers.get("content-type", ""):
+        return None, 0
+    try:
+        body = json.loads(request.content)
+    except (httpx.RequestNotRead, ValueError):
+        return None, 0
+    if not isinstance(body, dict):
+        return None, 0
+    # About 4 bytes a token for the input, and OpenAI counts the output cap against the limit up front
+    output_tokens = body.get("max_output_tokens") or body.get("max_completion_tokens") or body.get("max_tokens") or 0
+    return body.get("model"), len(request.content) // 4 + output_tokens
+
+
+def _should_retry(response):
+
+    # Same rules as the SDK's own retries
+    should_retry = response.headers.get("x-should-retry")
+    if should_retry in ("true", "false"):
+        return should_retry == "true"
+    return response.status_code in (408, 409, 429) or response.status_code >= 500
+
+
+def _retry_after(headers):
+
+    try:
+        return float(headers["retry-after-ms"]) / 1000
+    except (KeyError, ValueError):
+        pass
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+class ScheduledTransport(httpx.AsyncBaseTransport):
+    """Sends every request through the process-wide scheduler and retries rate limits, server and connection errors"""
+
+    def __init__(self, transport=None, scheduler=None):
+        self.transport = transport or httpx.AsyncHTTPTransport()
+        self.scheduler = scheduler or openai_scheduler
+
+    async def handle_async_request(self, request):
+
+        model, tokens = _describe(request)
+        priority = _priority.get()
+        if priority is None:
+            priority = PRIORITY_LOW if model in LOW_PRIORITY_MODELS else PRIORITY_HIGH
+
+        sequence = None
+        attempt = 0
+        while True:
+            ticket = await self.scheduler.acquire(model, tokens, priority, sequence)
+            sequence = ticket.rank[1]
+            # The telemetry span times the call itself, the wait is observed as queue time
+            request.extensions["telemetry_start"] = time.perf_counter()
+            try:
+                response = await self.transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # Nothing reached the server, safe to send again
+                self.scheduler.release()
+                if attempt >= OPENAI_MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+            except BaseException:
+                self.scheduler.release()
+                raise
+            else:
+                # A request counts as in flight until its headers arrive, a stream's body doesn't hold a slot
+                self.scheduler.release()
+                self.scheduler.update_limits(model, response.headers)
+                if attempt >= OPENAI_MAX_RETRIES or not _should_retry(response):
+                    return response
+                await response.aclose()
+                delay = backoff_delay(attempt, _retry_after(response.headers))
+                if response.status_code == 429 and model:
+                    print(f"OpenAI rate limit on {model}, pausing it {delay:.1f}s")
+                    # Every queued call to the model waits it out, the retry keeps its place in front of them
+                    self.scheduler.pause(model, delay)
+                    delay = 0
+
+            attempt += 1
+            record_retry("openai", model or "none")
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def aclose(self):
+
+        await self.transport.aclose()
@@ -0,0 +1,210 @@
+import os
+import re
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.ingestion import dataframe_to_parquet, archive_dataset_bundle
+from src.profiling import profile_dataset
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#    Local pre-aggregation for the analytics
+# --------------------------------------------
+
+# "aggregated" uploads the derived tables, "raw" uploads the whole bundle like before
+ANALYTICS_UPLOAD_MODE = os.getenv("ANALYTICS_UPLOAD_MODE", "aggregated")
+# Smaller datasets are cheap enough to upload as they are
+PREAGGREGATION_MIN_ROWS = int(os.getenv("PREAGGREGATION_MIN_ROWS", "100000"))
+# Rows of the stratified sample shipped alongside the aggregates, 0 to leave it out
+PREAGGREGATION_SAMPLE_ROWS = int(os.getenv("PREAGGREGATION_SAMPLE_ROWS", "20000"))
+MAX_DIMENSION_CARDINALITY = 1000
+MAX_DIMENSIONS = 6
+MAX_MEASURES = 8
+TOP_K = 50
+HISTOGRAM_BINS = 20
+SAMPLE_BATCH_ROWS = 65536
+
+# Column name fragments that usually mark what a business wants to slice and total by
+DIMENSION_HINTS = ("product", "item", "sku", "category", "region", "state", "city", "country", "store", "customer",
+                   "segment", "channel", "department", "employee", "vendor", "supplier", "ship", "market")
+MEASURE_HINTS = ("sales", "revenue", "profit", "amount", "price", "cost", "quantity", "qty", "discount", "margin",
+                 "total", "pay", "wage", "hours", "units")
+
+
+def _is_id_column(name):
+
+    # "id", "customer_id", "customerId", "CustomerID", but not "amount_paid" or "is_valid"
+    return bool(re.search(r"(^|[_\s-])id$", name, re.IGNORECASE) or re.search(r"[a-z](Id|ID)$", name))
+
+
+def _words(text):
+
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def _relevance(name, instruction_words, hints):
+
+    name_words = _words(name.replace("_", " "))
+    score = 2 * len(name_words & instruction_words)
+    score += any(hint in name.lower() for hint in hints)
+    return score
+
+
+def classify_columns(profile, instruction_words):
+    """Picks date, measure and dimension columns from a table profile, most relevant to the instructions first"""
+
+    dates, measures, dimensions = [], [], []
+    for column in profile["columns"]:
+        name = column["name"]
+        distinct = column["distinct"]
+        if "date_min" in column:
+            dates.append(name)
+        elif "min" in column:
+            # Identifiers are numeric but summing them means nothing
+            id_like = _is_id_column(name) or (distinct is not None and distinct == column["count"])
+            if not id_like:
+                measures.append(name)
+        elif distinct is not None and 1 < distinct <= MAX_DIMENSION_CARDINALITY:
+            dimensions.append(name)
+
+    measures.sort(key=lambda name: -_relevance(name, instruction_words, MEASURE_HINTS))
+    dimensions.sort(key=lambda name: -_relevance(name, instruction_words, DIMENSION_HINTS))
+    return dates, measures[:MAX_MEASURES], dimensions[:MAX_DIMENSIONS]
+
+
+def _aggregate(df, keys, measures):
+
+    grouped = df.groupby(keys, observed=True, dropna=False)
+    result = grouped[measures].agg(["sum", "mean"]) if measures else pd.DataFrame(index=grouped.size().index)
+    result.columns = [f"{measure}_{stat}" for measure, stat in result.columns] if measures else []
+    result["rows"] = grouped.size()
+    return result.reset_index()
+
+
+def _sample_positions(df, dimension, total_rows, sample_rows, seed=0):
+    """Sorted row positions of the sample, every group of the dimension gets at least one row"""
+
+    rng = np.random.default_rng(seed)
+    if total_rows <= sample_rows:
+        return np.arange(total_rows)
+    if dimension is None:
+        return np.sort(rng.choice(total_rows, sample_rows, replace=False))
+    fraction = sample_rows / total_rows
+    positions = [rng.choice(group, min(len(group), max(1, round(len(group) * fraction))), replace=False)
+                 for group in df.groupby(dimension, observed=True, dropna=False).indices.values()]
+    return np.sort(np.concatenate(positions))
+
+
+def _read_rows(path, positions, batch_rows=SAMPLE_BATCH_ROWS):
+    """Reads the rows at the given sorted positions with every column, one record batch at a time"""
+
+    parquet = pq.ParquetFile(path)
+    batches = []
+    offset = 0
+    for batch in parquet.iter_batches(batch_size=batch_rows):
+        start, end = np.searchsorted(positions, [offset, offset + batch.num_rows])
+        if end > start:
+            batches.append(batch.take(pa.array(positions[start:end] - offset)))
+        offset += batch.num_rows
+    return pa.Table.from_batches(batches, schema=parquet.schema_arrow).to_pandas()
+
+
+def _period(instruction_words):
+
+    if instruction_words & {"daily", "day", "days"}:
+        return "D"
+    if instruction_words & {"weekly", "week", "weeks"}:
+        return "W"
+    return "M"
+
+
+def preaggregate_table(table, instruction_words, sample_rows=PREAGGREGATION_SAMPLE_ROWS):
+    """Returns {derived table name: DataFrame} for one bundle table"""
+
+    profile = profile_dataset(table["path"])
+    dates, measures, dimensions = classify_columns(profile, instruction_words)
+    df = pq.read_table(table["path"], columns=dates[:1] + measures + dimensions).to_pandas()
+    for measure in measures:
+        df[measure] = pd.to_numeric(df[measure], errors="coerce")
+
+    name = table["name"]
+    derived = {}
+
+    if dates:
+        date_column = dates[0]
+        period = _period(instruction_words)
+        df["period"] = pd.to_datetime(df[date_column].astype(str), errors="coerce", format="mixed").dt.to_period(period).astype(str)
+        derived[f"{name}_by_period"] = _aggregate(df, ["period"], measures)
+        # Time by the most relevant dimension is usually what a trend question needs
+        if dimensions:
+            by_period_dimension = _aggregate(df, ["period", dimensions[0]], measures)
+            derived[f"{name}_by_period_{dimensions[0]}"] = by_period_dimension
+
+    for dimension in dimensions:
+        by_dimension = _aggregate(df, [dimension], measures)
+        order = f"{measures[0]}_sum" if measures else "rows"
+        derived[f"{name}_by_{dimension}"] = by_dimension.sort_values(order, ascending=False).head(TOP_K)
+
+    # Distribution sketches: quantiles and a fixed-bin histogram per measure
+    sketches = []
+    for measure in measures:
+        values = df[measure].dropna().to_numpy()
+        if values.size == 0:
+            continue
+        counts, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+        quantiles = np.quantile(values, [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99])
+        for i, count in enumerate(counts):
+            sketches.append({"measure": measure, "kind": "histogram", "low": edges[i], "high": edges[i + 1], "value": count})
+        for q, value in zip(["p1", "p5", "p25", "p50", "p75", "p95", "p99"], quantiles):
+            sketches.append({"measure": measure, "kind": q, "low": None, "high": None, "value": value})
+    if sketches:
+        derived[f"{name}_distributions"] = pd.DataFrame(sketches)
+
+    total_rows = pq.ParquetFile(table["path"]).metadata.num_rows
+    if sample_rows and total_rows > 0:
+        # Stratified on the main dimension so small groups still show up in the sample. Rows are picked
+        # from the columns already loaded, only the picked ones are read with the rest of their columns
+        positions = _sample_positions(df, dimensions[0] if dimensions else None, total_rows, sample_rows)
+        derived[f"{name}_sample"] = _read_rows(table["path"], positions)
+
+    return derived
+
+
+def should_preaggregate(manifest, mode=ANALYTICS_UPLOAD_MODE, min_rows=PREAGGREGATION_MIN_ROWS):
+
+    return mode == "aggregated" and sum(table["rows"] for table in manifest["tables"]) >= min_rows
+
+
+def build_preaggregated_bundle(manifest, instructions, bundle_dir=None):
+    """
+    Builds a bundle of derived tables (group-bys, distributions, samples) from a dataset bundle,
+    driven by the analytics instructions. Returns its manifest, already archived for upload.
+    """
+    bundle_dir = bundle_dir or tempfile.mkdtemp(prefix="derived_", dir=manifest["bundle_dir"])
+    instruction_words = _words(f"{instructions.tasks} {instructions.focus}")
+
+    tables = []
+    for table in manifest["tables"]:
+        try:
+            derived = preaggregate_table(table, instruction_words)
+        except Exception as e:
+            # The table goes up as it is rather than missing from the analysis
+            print(f"✗ Could not pre-aggregate {table['name']}, uploading it raw: {str(e)}")
+            tables.append(table)
+            continue
+        for derived_name, df in derived.items():
+            parquet_path = os.path.join(bundle_dir, f"{derived_name}.parquet")
+            rows, columns = dataframe_to_parquet(df, parquet_path)
+            tables.append({"name": derived_name, "source": table["name"], "path": parquet_path, "rows": rows,
+                           "columns": list(columns), "bytes": os.path.getsize(parquet_path)})
+
+    derived_manifest = {"bundle_dir": bundle_dir, "tables": tables}
+    archive_dataset_bundle(derived_manifest)
+
+    raw_bytes = sum(table["bytes"] for table in manifest["tables"])
+    derived_bytes = os.path.getsize(derived_manifest["archive_path"])
+    print(f"Pre-aggregated {raw_bytes} bytes of tables into {derived_bytes} bytes ({raw_bytes / max(derived_bytes, 1):.1f}x smaller)")
+    return derived_manifest
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import threading
+from collections import Counter, OrderedDict
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#              Dataset profiler
+# --------------------------------------------
+
+PROFILE_CACHE_DIR = os.getenv("PROFILE_CACHE_DIR", os.path.join("cache", "profiles"))
+PROFILE_CHUNK_ROWS = int(os.getenv("PROFILE_CHUNK_ROWS", "200000"))
+PROFILE_SAMPLE_ROWS = int(os.getenv("PROFILE_SAMPLE_ROWS", "50000"))
+# Distinct values are tracked exactly up to this many per column, after that we only report a lower bound
+MAX_TRACKED_DISTINCT = 100000
+# Category counts are pruned to this many candidates per column after each chunk
+MAX_TRACKED_CATEGORIES = 1000
+TOP_K = 5
+
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+_MEMORY_CACHE_SIZE = 64
+
+
+def get_file_hash(path, block_size=1024 * 1024):
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def iter_chunks(data_path, chunk_rows=PROFILE_CHUNK_ROWS, max_excel_rows=None):
+    """Yields DataFrames of at most chunk_rows rows so the whole file is never in memory at once"""
+
+    _, file_extension = os.path.splitext(data_path)
+    file_extension = file_extension.lower()
+
+    if file_extension == ".csv":
+        yield from pd.read_csv(data_path, chunksize=chunk_rows, low_memory=False)
+    elif file_extension == ".parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(data_path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    elif file_extension == ".xlsx":
+        # openpyxl can't stream into pandas, so workbooks are capped at max_excel_rows. One more row
+        # is read to tell a workbook of exactly that size from a longer one, which gets attrs["truncated"]
+        frame = pd.read_excel(data_path, nrows=max_excel_rows + 1 if max_excel_rows else None)
+        if max_excel_rows and len(frame) > max_excel_rows:
+            frame = frame.iloc[:max_excel_rows]
+            frame.attrs["truncated"] = True
+        yield frame
+    else:
+        raise ValueError("Unsupported file extension")
+
+
+class _ColumnStats:
+
+    def __init__(self, name):
+        self.name = name
+        self.dtypes = []
+        self.count = 0
+        self.null_count = 0
+        self.min = None
+        self.max = None
+        self.distinct_hashes = np.array([], dtype=np.uint64)
+        self.distinct_overflow = False
+        self.categories = Counter()
+        self.is_date = None
+        self.date_min = None
+        self.date_max = None
+
+    def update(self, series):
+
+        dtype = str(series.dtype)
+        if dtype not in self.dtypes:
+            self.dtypes.append(dtype)
+
+        self.count += len(series)
+        non_null = series.dropna()
+        self.null_count += len(series) - len(non_null)
+        if non_null.empty:
+            return
+
+        if not self.distinct_overflow:
+            hashes = pd.util.hash_pandas_object(non_null, index=False).to_numpy()
+            self.distinct_hashes = np.union1d(self.distinct_hashes, hashes)
+            if len(self.distinct_hashes) > MAX_TRACKED_DISTINCT:
+                self.distinct_overflow = True
+                self.distinct_hashes = np.array([], dtype=np.uint64)
+
+        if pd.api.types.is_numeric_dtype(non_null) and not pd.api.types.is_bool_dtype(non_null):
+            chunk_min, chunk_max = non_null.min(), non_null.max()
+            self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+            self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+            return
+
+        if pd.api.types.is_datetime64_any_dtype(non_null):
+            self.is_date = True
+            dates = non_null
+        else:
+            if self.is_date is None:
+                # Decide once, on the first non-empty chunk, whether a text column holds dates
+                probe = pd.to_datetime(non_null.head(1000).astype(str), errors="coerce", format="mixed")
+                self.is_date = bool(probe.notna().mean() > 0.9)
+            dates = pd.to_datetime(non_null.astype(str), errors="coerce", format="mixed") if self.is_date else None
+
+        if dates is not None:
+            dates = dates.dropna()
+            if not dates.empty:
+                self.date_min = dates.min() if self.date_min is None else min(self.date_min, dates.min())
+                self.date_max = dates.max() if self.date_max is None else max(self.date_max, dates.max())
+            return
+
+        self.categories.update(non_null.astype(str).value_counts().to_dict())
+        if len(self.categories) > MAX_TRACKED_CATEGORIES:
+            self.categories = Counter(dict(self.categories.most_common(MAX_TRACKED_CATEGORIES)))
+
+    def summary(self, sample):
+
+        column = {
+            "name": self.name,
+            "dtype": self.dtypes[0] if len(self.dtypes) == 1 else "mixed(" + ", ".join(self.dtypes) + ")",
+            "count": self.count,
+            "null_rate": round(self.null_count / self.count, 4) if self.count else 0.0,
+            "distinct": None if self.distinct_overflow else int(len(self.distinct_hashes)),
+            "distinct_at_least": MAX_TRACKED_DISTINCT if self.distinct_overflow else None,
+        }
+
+        if self.min is not None:
+            column["min"] = _to_python(self.min)
+            column["max"] = _to_python(self.max)
+            values = pd.to_numeric(sample[self.name], errors="coerce").dropna() if self.name in sample else pd.Series(dtype=float)
+            if not values.empty:
+                quantiles = values.quantile([0.05, 0.25, 0.5, 0.75, 0.95])
+                column["quantiles"] = {f"p{int(q * 100)}": _to_python(v) for q, v in quantiles.items()}
+                column["mean"] = _to_python(values.mean())
+        elif self.date_min is not None:
+            column["date_min"] = str(self.date_min)
+            column["date_max"] = str(self.date_max)
+        elif self.categories:
+            column["top_categories"] = [[value, count] for value, count in self.categories.most_common(TOP_K)]
+
+        return column
+
+
+def _to_python(value):
+
+    return value.item() if hasattr(value, "item") else value
+
+
+def _update_sample(sample, chunk, sample_rows, rng):
+
+    # Bottom-k sampling: every row gets a random key and we keep the sample_rows smallest,
+    # which is a uniform sample of the whole file regardless of how many chunks there are
+    chunk = chunk.assign(_sample_key=rng.random(len(chunk)))
+    if sample is not None:
+        chunk = pd.concat([sample, chunk], ignore_index=True)
+    if len(chunk) > sample_rows:
+        chunk = chunk.nsmallest(sample_rows, "_sample_key")
+    return chunk
+
+
+def profile_dataset(data_path, chunk_rows=PROFILE_CHUNK_ROWS, sample_rows=PROFILE_SAMPLE_ROWS, use_cache=True):
+    """
+    Profiles a CSV/XLSX/Parquet file in bounded memory.
+
+    Counts, null rates, cardinality, min/max and date ranges are computed over every row
+    in chunks; quantiles come from a uniform sample of sample_rows rows. Workbooks longer
+    than the XLSX cap are profiled from their first rows only, with rows_truncated set and
+    rows a lower bound.
+    Results are cached in memory and on disk by the file's content hash.
+    """
+    file_hash = get_file_hash(data_path)
+    cache_key = f"{file_hash}_{chunk_rows}_{sample_rows}"
+    cache_path = os.path.join(PROFILE_CACHE_DIR, f"{cache_key}.json")
+
+    if use_cache:
+        with _memory_cache_lock:
+            if cache_key in _memory_cache:
+                _memory_cache.move_to_end(cache_key)
+                return _memory_cache[cache_key]
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                profile = json.load(f)
+            _remember(cache_key, profile)
+            return profile
+
+    rng = np.random.default_rng(0)
+    columns = OrderedDict()
+    sample = None
+    rows = 0
+    truncated = False
+
+    for chunk in iter_chunks(data_path, chunk_rows, max_excel_rows=max(chunk_rows, sample_rows)):
+        rows += len(chunk)
+        truncated = truncated or chunk.attrs.get("truncated", False)
+        for name in chunk.columns:
+            columns.setdefault(name, _ColumnStats(name)).update(chunk[name])
+        sample = _update_sample(sample, chunk, sample_rows, rng)
+
+    sample = sample.drop(columns="_sample_key") if sample is not None else pd.DataFrame()
+
+    profile = {
+        "file_name": os.path.basename(data_path),
+        "file_hash": file_hash,
+        "file_size": os.path.getsize(data_path),
+        "rows": rows,
+        "rows_truncated": truncated,
+        "sampled_rows": len(sample),
+        "columns": [stats.summary(sample) for stats in columns.values()],
+    }
+
+    if use_cache:
+        os.makedirs(PROFILE_CACHE_DIR, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(profile, f, default=str)
+        os.replace(temp_path, cache_path)
+        _remember(cache_key, profile)
+
+    return profile
+
+
+def _remember(cache_key, profile):
+
+    with _memory_cache_lock:
+        _memory_cache[cache_key] = profile
+        _memory_cache.move_to_end(cache_key)
+        while len(_memory_cache) > _MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def format_profile(profile):
+    """Renders a profile as compact text for prompts"""
+
+    # Stats of a truncated workbook only cover its first rows, the prompt has to say so
+    rows = f"over {profile['rows']} rows (only the first {profile['rows']} profiled)" if profile.get("rows_truncated") else f"{profile['rows']} rows"
+    lines = [f"File {profile['file_name']}: {rows}, {len(profile['columns'])} columns"
+             f" (quantiles from a {profile['sampled_rows']} row sample)"]
+
+    for column in profile["columns"]:
+        distinct = column["distinct"] if column["distinct"] is not None else f">{column['distinct_at_least']}"
+        line = f"- {column['name']} [{column['dtype']}] nulls {column['null_rate']:.1%}, distinct {distinct}"
+        if "min" in column:
+            line += f", min {column['min']}, max {column['max']}"
+            if "quantiles" in column:
+                line += ", " + ", ".join(f"{q} {v:.4g}" for q, v in column["quantiles"].items())
+        elif "date_min" in column:
+            line += f", from {column['date_min']} to {column['date_max']}"
+        elif "top_categories" in column:
+            line += ", top: " + ", ".join(f"{value} ({count})" for value, count in column["top_categories"])
+        lines.append(line)
+
+    return "\n".join(lines)
@@ -0,0 +1,156 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#      Library of past research reports
+# --------------------------------------------
+
+RESEARCH_LIBRARY_PATH = os.getenv("RESEARCH_LIBRARY_PATH", os.path.join("cache", "research_library.sqlite3"))
+# Cosine similarity between TF-IDF vectors of the instructions needed to reuse a report
+RESEARCH_REUSE_SIMILARITY = float(os.getenv("RESEARCH_REUSE_SIMILARITY", "0.85"))
+# Industry research goes stale, older reports are never served
+RESEARCH_REUSE_MAX_AGE = float(os.getenv("RESEARCH_REUSE_MAX_AGE", str(30 * 24 * 3600)))
+RESEARCH_REUSE_ENABLED = os.getenv("RESEARCH_REUSE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "into", "is", "it", "its", "of", "on",
+    "or", "such", "that", "the", "their", "this", "to", "with", "you", "your", "should", "will", "while",
+}
+
+
+def tokenize(text):
+
+    words = [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOPWORDS]
+    # Crude plural folding so "store" and "stores" count as the same term
+    words = [word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word for word in words]
+    # Bigrams keep "general retail" apart from "retail" and "general" showing up separately
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+def instructions_text(instructions):
+
+    return f"{instructions.tasks}\n{instructions.focus}"
+
+
+class ResearchLibrary:
+    """
+    Past research reports indexed by the TF-IDF vectors of their instructions.
+
+    The index is rebuilt from SQLite once per process and kept up to date as reports
+    are added, lookups compare against every stored report, which is fine for the
+    few thousand reports a library holds.
+    """
+
+    def __init__(self, db_path=RESEARCH_LIBRARY_PATH):
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._documents = None
+        self._document_frequency = Counter()
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def _connect(self):
+
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS research_reports (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    instructions TEXT NOT NULL,
+                    report TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )""")
+            yield connection
+        finally:
+            connection.close()
+
+    def _load(self):
+
+        if self._documents is not None:
+            return
+        self._documents = []
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id, instructions, created_at FROM research_reports WHERE created_at > ?",
+                                      (time.time() - RESEARCH_REUSE_MAX_AGE,)).fetchall()
+        for report_id, instructions, created_at in rows:
+            self._index(report_id, instructions, created_at)
+
+    def _index(self, report_id, instructions, created_at):
+
+        term_counts = Counter(tokenize(instructions))
+        self._documents.append((report_id, term_counts, created_at))
+        self._document_frequency.update(term_counts.keys())
+
+    def _vector(self, term_counts):
+
+        n = len(self._documents) + 1
+        vector = {term: count * (math.log(n / (1 + self._document_frequency[term])) + 1) for term, count in term_counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+
+    def find(self, instructions, min_similarity=RESEARCH_REUSE_SIMILARITY, max_age=RESEARCH_REUSE_MAX_AGE):
+        """Returns (report, similarity) of the closest fresh enough report, or (None, best similarity)"""
+
+        with self._lock:
+            self._load()
+            query = self._vector(Counter(tokenize(instructions)))
+            now = time.time()
+            best_id, best_similarity = None, 0.0
+            for report_id, term_counts, created_at in self._documents:
+                if now - created_at > max_age:
+                    continue
+                document = self._vector(term_counts)
+                similarity = sum(weight * document.get(term, 0.0) for term, weight in query.items())
+                if similarity > best_similarity:
+                    best_id, best_similarity = report_id, similarity
+
+            if best_id is None or best_similarity < min_similarity:
+                self.misses += 1
+                self._log(best_similarity)
+                return None, best_similarity
+            self.hits += 1
+            self._log(best_similarity)
+
+        with self._connect() as connection:
+            report = connection.execute("SELECT report FROM research_reports WHERE id = ?", (best_id,)).fetchone()[0]
+        return report, best_similarity
+
+    def add(self, instructions, report):
+
+        created_at = time.time()
+        with self._connect() as connection:
+            report_id = connection.execute("INSERT INTO research_reports (instructions, report, created_at) VALUES (?, ?, ?)",
+                                           (instructions, report, created_at)).lastrowid
+        with self._lock:
+            if self._documents is not None:
+                self._index(report_id, instructions, created_at)
+
+    def _log(self, similarity):
+
+        total = self.hits + self.misses
+        print(f"Research library: best similarity {similarity:.2f}, hit rate {self.hits}/{total} ({self.hits / total:.0%})")
+
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def get_research_library():
+
+    global _library
+    with _library_lock:
+        if _library is None:
+            _library = ResearchLibrary()
+    return _library
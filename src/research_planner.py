@@ -0,0 +1,113 @@
+import os
+import re
+import tiktoken
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#     Pre-flight budget for deep research
+# --------------------------------------------
+
+# o3-deep-research fails once a run goes past its 200k token limit, plan for less than that
+RESEARCH_TOKEN_BUDGET = int(os.getenv("RESEARCH_TOKEN_BUDGET", "150000"))
+# Rough cost of one task: searches and page reads it triggers, and the tokens each of them pulls into context
+TOOL_CALLS_PER_TASK = int(os.getenv("RESEARCH_TOOL_CALLS_PER_TASK", "12"))
+TOKENS_PER_TOOL_CALL = int(os.getenv("RESEARCH_TOKENS_PER_TOOL_CALL", "3000"))
+# Fixed overhead of a run: planning, reasoning and the final report
+BASE_RUN_TOKENS = int(os.getenv("RESEARCH_BASE_RUN_TOKENS", "20000"))
+MAX_RESEARCH_PARTS = int(os.getenv("MAX_RESEARCH_PARTS", "4"))
+
+_encoding = None
+
+
+def count_tokens(text):
+
+    # tiktoken downloads o200k_base (the o-series tokenizer) on first use and caches it in TIKTOKEN_CACHE_DIR,
+    # pre-seed that directory on hosts without network. If the download fails, ~4 characters a token is close enough
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"Couldn't load the o200k_base tokenizer, estimating tokens from the text length: {e}")
+            _encoding = False
+    if not _encoding:
+        return len(text) // 4
+    return len(_encoding.encode(text))
+
+
+def split_tasks(tasks):
+    """Splits the manager's task text into individual tasks: numbered or bulleted lines, else sentences"""
+
+    lines = [line.strip() for line in tasks.splitlines() if line.strip()]
+    items = [re.sub(r"^(\d+[\.\)]|[-*•])\s*", "", line) for line in lines if re.match(r"^(\d+[\.\)]|[-*•])\s*", line)]
+    if len(items) > 1:
+        return items
+    # Inline lists like "1) do x 2) do y"
+    items = [item.strip(" ;,") for item in re.split(r"\s*(?:^|\s)\d+[\.\)]\s+", tasks) if item.strip(" ;,")]
+    if len(items) > 1:
+        return items
+    items = [item.strip() for item in re.split(r"(?<=[\.;])\s+", tasks) if item.strip()]
+    return items or [tasks]
+
+
+def estimate_tokens(tasks, focus):
+
+    prompt_tokens = count_tokens(research_prompt(tasks, focus))
+    return prompt_tokens + BASE_RUN_TOKENS + len(split_tasks(tasks)) * TOOL_CALLS_PER_TASK * TOKENS_PER_TOOL_CALL
+
+
+def research_prompt(tasks, focus):
+
+    return f"""You have this task: {tasks}
+            You should accomplish it while mainting this focus: {focus}
+            """
+
+
+def plan_research(instructions, budget=RESEARCH_TOKEN_BUDGET, max_parts=MAX_RESEARCH_PARTS):
+    """
+    Estimates the token budget of the research instructions and, when over budget,
+    groups the tasks into up to max_parts smaller research jobs that fit it.
+
+    Returns a plan dict with the estimate and the prompt of every part, which is
+    deterministic for the same instructions so a resumed run gets the same parts.
+    """
+    tasks = split_tasks(instructions.tasks)
+    estimated_tokens = estimate_tokens(instructions.tasks, instructions.focus)
+
+    if estimated_tokens <= budget or len(tasks) == 1:
+        groups = [tasks]
+    else:
+        # Greedy packing in the original order, tasks next to each other tend to be related
+        per_task = TOOL_CALLS_PER_TASK * TOKENS_PER_TOOL_CALL
+        tasks_per_part = max(1, (budget - BASE_RUN_TOKENS - count_tokens(instructions.focus)) // per_task)
+        parts = min(max_parts, -(-len(tasks) // tasks_per_part))
+        tasks_per_part = -(-len(tasks) // parts)
+        groups = [tasks[i:i + tasks_per_part] for i in range(0, len(tasks), tasks_per_part)]
+
+    if len(groups) == 1:
+        prompts = [research_prompt(instructions.tasks, instructions.focus)]
+    else:
+        prompts = [research_prompt("\n".join(f"{i + 1}. {task}" for i, task in enumerate(group)), instructions.focus) for group in groups]
+
+    return {
+        "budget": budget,
+        "task_count": len(tasks),
+        "estimated_tokens": estimated_tokens,
+        "parts": [{"tasks": group, "estimated_tokens": estimate_tokens("\n".join(group), instructions.focus)} for group in groups],
+        "prompts": prompts,
+    }
+
+
+def merge_research_reports(plan, reports):
+    """Joins the reports of every part, in plan order, under a heading listing the tasks it covered.
+    A part that failed keeps its heading with a note, so the gap shows in the report"""
+
+    if len(reports) == 1:
+        return reports[0]
+    sections = []
+    for i, (part, report) in enumerate(zip(plan["parts"], reports)):
+        if report is None:
+            report = f"Research part {i + 1} failed, these tasks weren't researched."
+        sections.append(f"## Research part {i + 1}: {'; '.join(part['tasks'])}\n\n{report}")
+    return "\n\n---------------\n\n".join(sections)
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+from src.telemetry import observe
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#     Background deep research submissions
+# --------------------------------------------
+
+RESEARCH_RUNS_PATH = os.getenv("RESEARCH_RUNS_PATH", os.path.join("cache", "research_runs.sqlite3"))
+POLL_INITIAL_DELAY = float(os.getenv("RESEARCH_POLL_INITIAL_DELAY", "5"))
+POLL_MAX_DELAY = float(os.getenv("RESEARCH_POLL_MAX_DELAY", "60"))
+# Stop waiting on a single response after this long, deep research normally finishes well within it
+POLL_TIMEOUT = float(os.getenv("RESEARCH_POLL_TIMEOUT", "7200"))
+
+PENDING_STATUSES = ("queued", "in_progress")
+
+_initialized = set()
+
+
+class ResearchFailedError(Exception):
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        # The error code of a failed response, e.g. rate_limit_exceeded
+        self.code = code
+
+
+@contextmanager
+def _connect(db_path=None):
+
+    db_path = db_path or RESEARCH_RUNS_PATH
+    if db_path not in _initialized and os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    try:
+        if db_path not in _initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS research_runs (
+                    request_id TEXT NOT NULL,
+                    part INTEGER NOT NULL,
+                    attempt INTEGER NOT NULL,
+                    response_id TEXT NOT NULL,
+                    input_text TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (request_id, part, attempt)
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS research_plans (
+                    request_id TEXT PRIMARY KEY,
+                    plan TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )""")
+            _initialized.add(db_path)
+        yield connection
+    finally:
+        connection.close()
+
+
+def get_latest_run(request_id, part=0):
+
+    with _connect() as connection:
+        row = connection.execute("SELECT * FROM research_runs WHERE request_id = ? AND part = ? ORDER BY attempt DESC LIMIT 1", (request_id, part)).fetchone()
+    return dict(row) if row else None
+
+
+def save_run(request_id, part, attempt, response_id, input_text, status):
+
+    now = time.time()
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO research_runs (request_id, part, attempt, response_id, input_text, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (request_id, part, attempt, response_id, input_text, status, now, now))
+
+
+def get_plan(request_id):
+
+    with _connect() as connection:
+        row = connection.execute("SELECT plan FROM research_plans WHERE request_id = ?", (request_id,)).fetchone()
+    return json.loads(row["plan"]) if row else None
+
+
+def save_plan(request_id, plan):
+
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO research_plans (request_id, plan, created_at) VALUES (?, ?, ?)",
+                           (request_id, json.dumps(plan), time.time()))
+
+
+def update_run_status(response_id, status):
+
+    with _connect() as connection:
+        connection.execute("UPDATE research_runs SET status = ?, updated_at = ? WHERE response_id = ?", (status, time.time(), response_id))
+
+
+async def poll_response(client, response_id, initial_delay=POLL_INITIAL_DELAY, max_delay=POLL_MAX_DELAY, timeout=POLL_TIMEOUT):
+    """
+    Waits for a background response to finish and returns it.
+
+    Polls often at first and backs off up to max_delay, with jitter so
+    concurrent jobs don't poll in lockstep. Raises ResearchFailedError if the
+    response ends in any status other than completed.
+    """
+    start = time.monotonic()
+    delay = initial_delay
+    last_status = None
+
+    while True:
+        response = await client.responses.retrieve(response_id)
+
+        if response.status != last_status:
+            print(f"Research {response_id}: {response.status}")
+            if last_status == "queued":
+                # Time deep research spent waiting for capacity before it started working
+                observe("queue", "deep_research", time.monotonic() - start)
+            last_status = response.status
+            await asyncio.to_thread(update_run_status, response_id, response.status)
+
+        if response.status == "completed":
+            return response
+        if response.status not in PENDING_STATUSES:
+            error = getattr(response, 'error', None)
+            raise ResearchFailedError(f"Research {response_id} ended as {response.status}: {error or getattr(response, 'incomplete_details', None)}",
+                                      code=getattr(error, 'code', None))
+        if time.monotonic() - start > timeout:
+            raise ResearchFailedError(f"Research {response_id} still {response.status} after {timeout}s")
+
+        await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(delay * 1.5, max_delay)
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#    Stored results and duplicate requests
+# --------------------------------------------
+
+RESULT_STORE_PATH = os.getenv("RESULT_STORE_PATH", os.path.join("cache", "results.sqlite3"))
+# Finished results are served to retried and identical requests for this long
+RESULT_TTL = float(os.getenv("RESULT_TTL", str(24 * 3600)))
+# Set to 0 to run every request, identical or not; bypass_llm_cache also forces a fresh run
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1").lower() in ("1", "true", "yes")
+# How often a duplicate checks whether the request it's attached to is done
+DEDUP_POLL_INTERVAL = float(os.getenv("DEDUP_POLL_INTERVAL", "2"))
+
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# What claim() decided for a request
+LEADER = "leader"
+FOLLOWER = "follower"
+COMPLETED = "completed"
+
+_initialized = set()
+
+
+@contextmanager
+def _connect(db_path=None):
+
+    db_path = db_path or RESULT_STORE_PATH
+    if db_path not in _initialized and os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    try:
+        if db_path not in _initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS analysis_results (
+                    request_id TEXT PRIMARY KEY,
+                    content_key TEXT,
+                    state TEXT NOT NULL,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS analysis_results_content ON analysis_results (content_key, state)")
+            _initialized.add(db_path)
+        yield connection
+    finally:
+        connection.close()
+
+
+def content_key(goal, business_profile, file_hashes):
+    """Same goal, profile and file contents give the same key, whatever the request_id, file names or file order"""
+
+    payload = json.dumps({"goal": " ".join(goal.split()), "business_profile": " ".join(business_profile.split()),
+                          "files": sorted(file_hashes)})
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def claim(request_id, key, is_active):
+    """
+    Decides who does the work for a request with this content key. Returns
+    (COMPLETED, result) when an identical request finished within RESULT_TTL,
+    (FOLLOWER, leader_request_id) when an identical one is still running, and
+    (LEADER, None) when this request runs the pipeline itself.
+
+    is_active(request_id) tells whether a running request's job is still alive,
+    one that failed or was given up on after a restart doesn't hold the others back.
+    """
+    now = time.time()
+    with _connect() as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM analysis_results WHERE finished_at < ?", (now - RESULT_TTL,))
+            rows = connection.execute("SELECT request_id, state, result FROM analysis_results WHERE content_key = ? AND request_id != ? AND state IN (?, ?) ORDER BY created_at",
+                                      (key, request_id, SUCCEEDED, RUNNING)).fetchall()
+            completed = next((row for row in rows if row["state"] == SUCCEEDED), None)
+            if completed:
+                connection.execute("COMMIT")
+                return COMPLETED, json.loads(completed["result"])
+            leader = next((row["request_id"] for row in rows if is_active(row["request_id"])), None)
+            if leader:
+                connection.execute("COMMIT")
+                return FOLLOWER, leader
+            connection.execute("INSERT OR REPLACE INTO analysis_results (request_id, content_key, state, result, created_at, finished_at) VALUES (?, ?, ?, NULL, ?, NULL)",
+                               (request_id, key, RUNNING, now))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+    return LEADER, None
+
+
+def get_run(request_id):
+    """State and result of a request, (None, None) if it isn't stored"""
+
+    with _connect() as connection:
+        row = connection.execute("SELECT state, result FROM analysis_results WHERE request_id = ?", (request_id,)).fetchone()
+    if row is None:
+        return None, None
+    return row["state"], json.loads(row["result"]) if row["result"] else None
+
+
+def get_result(request_id):
+    """The stored result of a request that finished within RESULT_TTL, or None"""
+
+    with _connect() as connection:
+        row = connection.execute("SELECT result FROM analysis_results WHERE request_id = ? AND state = ? AND finished_at >= ?",
+                                 (request_id, SUCCEEDED, time.time() - RESULT_TTL)).fetchone()
+    return json.loads(row["result"]) if row else None
+
+
+def save_result(request_id, result, key=None):
+
+    # A resumed run doesn't know its content key anymore, it keeps the one from its first attempt
+    now = time.time()
+    with _connect() as connection:
+        connection.execute("""
+            INSERT INTO analysis_results (request_id, content_key, state, result, created_at, finished_at) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(request_id) DO UPDATE SET content_key = COALESCE(excluded.content_key, content_key),
+                state = excluded.state, result = excluded.result, finished_at = excluded.finished_at""",
+                           (request_id, key, SUCCEEDED, json.dumps(result), now, now))
+
+
+def fail_run(request_id):
+
+    # Identical requests waiting on this one stop waiting and one of them takes over
+    with _connect() as connection:
+        connection.execute("UPDATE analysis_results SET state = ?, finished_at = ? WHERE request_id = ? AND state = ?",
+                           (FAILED, time.time(), request_id, RUNNING))
@@ -1,93 +1,237 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 import boto3
 import os
 import tempfile
+import threading
+import time
+from src.telemetry import instrument_s3
+from src.snapshot_cache import entry_lock, get_cached_snapshot, put_cached_snapshot
 from dotenv import load_dotenv
 load_dotenv()
 
+DECRYPTION_FAILED_MESSAGE = """Data could not be decrypted with available keys.
+            The user that uploaded this data might have used its own encryption key running the app in developer mode"""
+
+# A client's snapshot list is relisted in full once it's older than this, new snapshots
+# don't necessarily sort after the ones we already know about
+SNAPSHOT_CACHE_TTL = float(os.getenv("SNAPSHOT_CACHE_TTL", "60"))
+# The <root>/ prefixes of the bucket change rarely, they are relisted this often
+SNAPSHOT_FULL_REFRESH_TTL = float(os.getenv("SNAPSHOT_FULL_REFRESH_TTL", "900"))
+
+_keyring = None
+_keyring_lock = threading.Lock()
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+# (bucket_name, client_name) -> {"snapshots": [...], "fetched_at": float}
+_snapshot_catalog = {}
+# One per (bucket_name, client_name), so a slow listing only holds up requests for that same client
+_refresh_locks = {}
+# bucket_name -> (root prefixes, fetched_at)
+_root_prefixes = {}
+_catalog_lock = threading.Lock()
+
+
+def get_s3_client(client_kwargs=None):
+
+    # boto3 clients are thread safe, so one per process is enough when using the env credentials
+    global _s3_client
+    if client_kwargs is not None:
+        return instrument_s3(boto3.client('s3', **client_kwargs))
+
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = instrument_s3(boto3.client(
+                's3',
+                region_name=os.environ["AWS_REGION"],
+                aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+                aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"]
+            ))
+    return _s3_client
+
+
+def _list_common_prefixes(s3_client, bucket_name, prefix=""):
+
+    prefixes = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            prefixes.append(common_prefix["Prefix"])
+    return prefixes
+
+
+def get_root_prefixes(s3_client, bucket_name):
+
+    # Keys are laid out as <root>/<client>/..., the root can be pinned with AWS_S3_ROOT_PREFIX
+    root_prefix = os.getenv("AWS_S3_ROOT_PREFIX")
+    if root_prefix:
+        return [root_prefix.rstrip("/") + "/"]
+
+    cached = _root_prefixes.get(bucket_name)
+    if cached is None or time.time() - cached[1] >= SNAPSHOT_FULL_REFRESH_TTL:
+        cached = _root_prefixes[bucket_name] = (_list_common_prefixes(s3_client, bucket_name), time.time())
+    return cached[0]
+
+
 def get_client_list(client_kwargs, bucket_name):
 
   client_list = []
-  s3_client = boto3.client('s3', **client_kwargs)
+  s3_client = get_s3_client(client_kwargs)
 
   try:
 
-      response = s3_client.list_objects_v2(
-          Bucket=bucket_name
-      )
-
-      for obj in response.get("Contents", []):
-          s3_object_spl = obj["Key"].split("/")
-          client = s3_object_spl[1]
-          if client not in client_list:
-              client_list.append(client)
+      # Only walk the <root>/<client>/ level instead of every object in the bucket
+      for root_prefix in get_root_prefixes(s3_client, bucket_name):
+          for client_prefix in _list_common_prefixes(s3_client, bucket_name, root_prefix):
+              client = client_prefix[len(root_prefix):].strip("/")
+              if client not in client_list:
+                  client_list.append(client)
 
   except Exception as e:
       print(e)
 
   return client_list
 
+
+def _list_snapshots(s3_client, bucket_name, client_name):
+
+    snapshots = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for root_prefix in get_root_prefixes(s3_client, bucket_name):
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{root_prefix}{client_name}/"):
+            for obj in page.get("Contents", []):
+                if "snapshots" in obj["Key"]:
+                    snapshots.append({
+                        "key": obj["Key"],
+                        "etag": obj.get("ETag", "").strip('"'),
+                        "size": obj.get("Size", 0),
+                        "last_modified": obj["LastModified"].timestamp() if obj.get("LastModified") else 0.0
+                    })
+    return snapshots
+
+
+def get_snapshot_catalog(client_name, bucket_name=None, s3_client=None, force_refresh=False):
+    """Snapshots of a client sorted oldest to newest, served from an in-process TTL cache"""
+
+    bucket_name = bucket_name or os.environ["AWS_S3_BUCKET"]
+    s3_client = s3_client or get_s3_client()
+    catalog_key = (bucket_name, client_name)
+    requested_at = time.time()
+
+    with _catalog_lock:
+        entry = _snapshot_catalog.get(catalog_key)
+        if entry is not None and not force_refresh and requested_at - entry["fetched_at"] < SNAPSHOT_CACHE_TTL:
+            return list(entry["snapshots"])
+        refresh_lock = _refresh_locks.setdefault(catalog_key, threading.Lock())
+
+    # The listing itself runs outside _catalog_lock, lookups for other clients don't wait on it
+    with refresh_lock:
+        with _catalog_lock:
+            entry = _snapshot_catalog.get(catalog_key)
+        # Someone else relisted while we waited, that's as fresh as a listing of our own
+        if entry is not None and entry["fetched_at"] >= requested_at:
+            return list(entry["snapshots"])
+
+        fetched_at = time.time()
+        snapshots = _list_snapshots(s3_client, bucket_name, client_name)
+        # Dedupe by key and sort deterministically so snapshot_idx always points at the same object
+        by_key = {snapshot["key"]: snapshot for snapshot in snapshots}
+        entry = {"snapshots": sorted(by_key.values(), key=lambda snapshot: (snapshot["last_modified"], snapshot["key"])),
+                 "fetched_at": fetched_at}
+        with _catalog_lock:
+            _snapshot_catalog[catalog_key] = entry
+
+    return list(entry["snapshots"])
+
+
+def get_keyring():
+
+    # Fernet objects are built once per process instead of on every decryption.
+    # Keys are tried in this order, so the primary key stays first
+    global _keyring
+    with _keyring_lock:
+        if _keyring is None:
+            named_fernets = []
+            for key_name in ("ENCRYPTION_KEY", "ALT_ENCRYPTION_KEY"):
+                encryption_key = os.getenv(key_name)
+                if not encryption_key:
+                    continue
+                try:
+                    named_fernets.append((key_name, Fernet(encryption_key.encode())))
+                except Exception as e:
+                    print(f"Invalid {key_name}: {e}")
+            multi_fernet = MultiFernet([fernet for _, fernet in named_fernets]) if named_fernets else None
+            _keyring = (named_fernets, multi_fernet)
+    return _keyring
+
+
+def decrypt_snapshot(ciphertext):
+    """Returns the decrypted text and the name of the env var holding the key that matched"""
+
+    named_fernets, multi_fernet = get_keyring()
+    if multi_fernet is None:
+        raise InvalidToken("No encryption keys configured")
+
+    decrypted = multi_fernet.decrypt(ciphertext).decode()
+
+    # Checking the HMAC alone is cheap next to a decryption, so this is how we tell which key matched
+    for key_name, fernet in named_fernets:
+        try:
+            fernet.extract_timestamp(ciphertext)
+            return decrypted, key_name
+        except InvalidToken:
+            continue
+
+    return decrypted, None
+
+
 def fernet_decryption(ciphertext):
 
     try:
-        encryption_key = os.environ["ENCRYPTION_KEY"]
-        fernet = Fernet(encryption_key.encode())
-        decrypted = fernet.decrypt(ciphertext).decode()
+        decrypted, key_name = decrypt_snapshot(ciphertext)
+        print(f"Decrypted with {key_name}")
     except Exception as e:
         print(e)
-        try:
-            encryption_key = os.environ["ALT_ENCRYPTION_KEY"]
-            fernet = Fernet(encryption_key.encode())
-            decrypted = fernet.decrypt(ciphertext).decode()
-        except Exception as e:
-            print(e)
-            decrypted = """Data could not be decrypted with available keys.
-            The user that uploaded this data might have used its own encryption key running the app in developer mode"""
-
-
+        decrypted = DECRYPTION_FAILED_MESSAGE
 
     return decrypted
 
 def get_client_snapshot(client_name, snapshot_idx):
     
     bucket_name = os.environ["AWS_S3_BUCKET"]
-    client_kwargs = {
-            'region_name': os.environ["AWS_REGION"],
-            'aws_access_key_id': os.environ["AWS_ACCESS_KEY_ID"],
-            'aws_secret_access_key': os.environ["AWS_SECRET_ACCESS_KEY"]
-        }
+    s3_client = get_s3_client()
 
-    snapshot_list = []
     try:
 
-        s3_client = boto3.client('s3', **client_kwargs)
-
-        response = s3_client.list_objects_v2(
-            Bucket=bucket_name
-        )
-
-        for obj in response.get("Contents", []):
-            if client_name in obj["Key"] and "snapshots" in obj["Key"]:
-                snapshot_list.append(obj["Key"])
+        snapshot_list = get_snapshot_catalog(client_name, bucket_name, s3_client)
 
         if not snapshot_list:
             return f"No snapshot found for client {client_name}"
 
+        snapshot_name = snapshot_list[snapshot_idx]["key"]
+
+    except IndexError:
+        return f"Snapshot index {snapshot_idx} out of range for client {client_name}"
     except Exception as e:
         print(e)
+        return f"Could not list snapshots for client {client_name}"
 
-    
-    snapshot_name = snapshot_list[snapshot_idx]
-    snapshot_file_name = snapshot_name.split("/")[-1]
-    local_path = f"downloads/{client_name}_{snapshot_file_name}"
+    # A HEAD is enough to tell whether the decrypted copy on disk is still current
+    etag = s3_client.head_object(Bucket=bucket_name, Key=snapshot_name)["ETag"].strip('"')
+
+    with entry_lock(bucket_name, snapshot_name, etag):
+
+        decrypted_snapshot = get_cached_snapshot(bucket_name, snapshot_name, etag)
+        if decrypted_snapshot is not None:
+            return decrypted_snapshot
 
-    s3_client.download_file(
-    Bucket=bucket_name,
-    Key=snapshot_name,
-    Filename=local_path
-    )
+        # Decrypt straight from the response body, there's no need for a copy in downloads/
+        response = s3_client.get_object(Bucket=bucket_name, Key=snapshot_name)
+        decrypted_snapshot = fernet_decryption(response["Body"].read())
 
-    decrypted_snapshot = fernet_decryption(open(local_path, "rb").read())
+        if decrypted_snapshot != DECRYPTION_FAILED_MESSAGE:
+            put_cached_snapshot(bucket_name, snapshot_name, etag, decrypted_snapshot)
 
     return decrypted_snapshot
 
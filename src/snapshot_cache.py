@@ -0,0 +1,107 @@
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#        Decrypted snapshot cache on disk
+# --------------------------------------------
+
+SNAPSHOT_CACHE_DIR = os.getenv("SNAPSHOT_CACHE_DIR", os.path.join("cache", "snapshots"))
+SNAPSHOT_CACHE_MAX_BYTES = int(os.getenv("SNAPSHOT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+_lock = threading.Lock()
+# One lock per cache entry so two requests for the same snapshot only download it once,
+# with the number of requests holding or waiting on it, it's dropped when that gets back to 0
+_key_locks = {}
+
+
+def _entry_path(bucket_name, key, etag, cache_dir=None):
+
+    # The ETag changes whenever the object does, so a new upload never hits a stale entry
+    digest = hashlib.sha256(f"{bucket_name}/{key}/{etag}".encode()).hexdigest()
+    return os.path.join(cache_dir or SNAPSHOT_CACHE_DIR, f"{digest}.snapshot")
+
+
+@contextmanager
+def entry_lock(bucket_name, key, etag):
+
+    entry = (bucket_name, key, etag)
+    with _lock:
+        lock_users = _key_locks.setdefault(entry, [threading.Lock(), 0])
+        lock_users[1] += 1
+    try:
+        with lock_users[0]:
+            yield
+    finally:
+        with _lock:
+            lock_users[1] -= 1
+            if lock_users[1] == 0:
+                del _key_locks[entry]
+
+
+def get_cached_snapshot(bucket_name, key, etag, cache_dir=None):
+
+    path = _entry_path(bucket_name, key, etag, cache_dir)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            snapshot = f.read()
+        # Bump the mtime so eviction is least-recently-used rather than least-recently-written
+        os.utime(path, None)
+        return snapshot
+    except FileNotFoundError:
+        return None
+
+
+def put_cached_snapshot(bucket_name, key, etag, snapshot, cache_dir=None, max_bytes=None):
+
+    cache_dir = cache_dir or SNAPSHOT_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _entry_path(bucket_name, key, etag, cache_dir)
+
+    # Write to a temp file and rename it into place so readers (other threads or
+    # other workers sharing the directory) never see a half written entry
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    evict_snapshots(cache_dir, max_bytes)
+    return path
+
+
+def evict_snapshots(cache_dir=None, max_bytes=None):
+
+    cache_dir = cache_dir or SNAPSHOT_CACHE_DIR
+    max_bytes = SNAPSHOT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    with _lock:
+        entries = []
+        total = 0
+        for entry in os.scandir(cache_dir):
+            if not entry.name.endswith(".snapshot"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        # Oldest access first
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except FileNotFoundError:
+                pass
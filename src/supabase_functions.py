@@ -1,94 +1,284 @@
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
 from typing import List, Dict, Any
-from supabase import create_client
+from concurrent.futures import ThreadPoolExecutor
+from src.telemetry import observe, trace
+import hashlib
+import tempfile
+import threading
+import time
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
-def download_and_process_files(file_urls: List[str]) -> List[Dict[str, Any]]:
+# One pooled session shared by all download workers, so connections to the
+# Supabase storage host are reused instead of re-negotiated per file
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+_session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+
+CHUNK_SIZE = 1024 * 1024
+MAX_DOWNLOAD_WORKERS = int(os.getenv("MAX_DOWNLOAD_WORKERS", "4"))
+DEFAULT_CONFIDENCE = 75
+DEFAULT_PAYBACK_MONTHS = 2
+# A request's progress is written at most once per this many seconds, whatever happens in between is coalesced
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "2"))
+
+_supabase = None
+_supabase_lock = threading.Lock()
+
+
+def get_supabase():
+    """Process-wide Supabase client, created on first use"""
+
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                # supabase pulls in its auth, storage and realtime clients, so it's only loaded on first use
+                from supabase import create_client
+                _supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+    return _supabase
+
+
+def download_file(url: str, download_dir: str = None) -> Dict[str, Any]:
     """
-    Download files from URLs and process them based on file type.
-    
+    Stream a single file to a temp file on disk in chunks.
+
     Args:
-        file_urls: List of public URLs to files in Supabase Storage
-        
+        url: Public URL to a file in Supabase Storage
+        download_dir: Directory for the temp file (system default if None)
+
     Returns:
-        List of dicts containing file metadata and content
+        Dict containing file metadata and the local path of the download
     """
-    processed_files = []
-    
-    for url in file_urls:
-        try:
-            # Download the file
-            response = requests.get(url, timeout=30)
+    # Extract filename from URL
+    filename = url.split('/')[-1].split('?')[0]
+    _, extension = os.path.splitext(filename)
+    file_data = {
+        'filename': filename,
+        'url': url,
+        'path': None,
+        'size': 0,
+        'content_type': '',
+        'sha256': None,
+        'seconds': 0.0,
+        'error': None
+    }
+
+    start = time.perf_counter()
+    temp_path = None
+    try:
+        with _session.get(url, stream=True, timeout=(10, 300)) as response:
             response.raise_for_status()
-            
-            # Extract filename from URL
-            filename = url.split('/')[-1].split('?')[0]
-            content_type = response.headers.get('content-type', '')
-            
-            file_data = {
-                'filename': filename,
-                'url': url,
-                'size': len(response.content),
-                'content_type': content_type,
-                'content': None,
-                'error': None
-            }
-            print(f"Downloading: {filename} ({file_data['size']} bytes)")
-                
-            file_data['content'] = response.content
-            processed_files.append(file_data)
-            print(f"✓ Successfully downloaded: {filename}")
-            
-        except requests.exceptions.RequestException as e:
-            print(f"✗ Failed to download {url}: {str(e)}")
-            processed_files.append({
-                'filename': url.split('/')[-1],
-                'url': url,
-                'error': str(e)
-            })
-        except Exception as e:
-            print(f"✗ Failed to process {url}: {str(e)}")
-            processed_files.append({
-                'filename': url.split('/')[-1],
-                'url': url,
-                'error': str(e)
-            })
-    
+            file_data['content_type'] = response.headers.get('content-type', '')
+            total = int(response.headers.get('content-length') or 0)
+            print(f"Downloading: {filename} ({total or 'unknown'} bytes)")
+
+            with tempfile.NamedTemporaryFile(delete=False, suffix=extension or ".tmp", dir=download_dir) as tmp:
+                temp_path = tmp.name
+                next_report = 0.25
+                # Hashed on the way to disk, identical uploads are recognized without reading the file again
+                sha = hashlib.sha256()
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    tmp.write(chunk)
+                    sha.update(chunk)
+                    file_data['size'] += len(chunk)
+                    if total and file_data['size'] / total >= next_report:
+                        print(f"  {filename}: {file_data['size'] / total:.0%}")
+                        next_report += 0.25
+
+        file_data['path'] = temp_path
+        file_data['sha256'] = sha.hexdigest()
+        file_data['seconds'] = time.perf_counter() - start
+        print(f"✓ Successfully downloaded: {filename} ({file_data['size']} bytes in {file_data['seconds']:.2f}s)")
+
+    except Exception as e:
+        print(f"✗ Failed to download {url}: {str(e)}")
+        file_data['error'] = str(e)
+        file_data['seconds'] = time.perf_counter() - start
+        if temp_path and os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+    return file_data
+
+
+def download_and_process_files(file_urls: List[str], max_workers: int = MAX_DOWNLOAD_WORKERS) -> List[Dict[str, Any]]:
+    """
+    Download files from URLs concurrently, streaming each one to its own temp file.
+
+    Args:
+        file_urls: List of public URLs to files in Supabase Storage
+        max_workers: Maximum number of files downloaded at the same time
+
+    Returns:
+        List of dicts containing file metadata and local path, in the same order as file_urls.
+        The caller owns the temp files and is responsible for deleting them.
+    """
+    if not file_urls:
+        return []
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(file_urls)))) as executor:
+        processed_files = list(executor.map(download_file, file_urls))
+
+    for file_data in processed_files:
+        observe("supabase", "storage_download", file_data['seconds'], "error" if file_data['error'] else "ok")
+
+    total_bytes = sum(f['size'] for f in processed_files)
+    print(f"Downloaded {len(processed_files)} files ({total_bytes} bytes) in {time.perf_counter() - start:.2f}s")
+
     return processed_files
 
 
-def save_report_in_supabase(request_id: str, recommendation: str, impact: float):
+class ProgressReporter:
+    """
+    Write-behind progress updates for the requests table.
 
-    supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-    )
+    report() only records the latest percentage of a request, a single background
+    thread writes it out, at most once per min_interval for each request. A burst of
+    node completions across many jobs becomes a handful of small updates.
+    """
+
+    def __init__(self, min_interval=PROGRESS_MIN_INTERVAL):
+
+        self.min_interval = min_interval
+        self._pending = {}
+        self._reported = {}
+        self._last_write = {}
+        # Runs that ended with progress still pending, forgotten once it's written
+        self._ended = set()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def report(self, request_id, percentage):
+
+        with self._lock:
+            # Progress never goes backwards within a run, a resumed one counts its checkpointed nodes as done
+            if percentage <= self._reported.get(request_id, 0):
+                return
+            self._reported[request_id] = percentage
+            self._pending[request_id] = percentage
+        self.start()
+        self._wakeup.set()
+
+    def discard(self, request_id):
+        """Drops whatever is still pending for a request, its final write carries the progress instead"""
+
+        # Also waits for a write of this request that's already on its way
+        with self._write_lock, self._lock:
+            self._pending.pop(request_id, None)
+            self._reported.pop(request_id, None)
+            self._last_write.pop(request_id, None)
+            self._ended.discard(request_id)
+
+    def forget(self, request_id):
+        """Drops what is kept about a run that ended without saving its report, after its last pending write"""
+
+        with self._lock:
+            self._reported.pop(request_id, None)
+            if request_id in self._pending:
+                self._ended.add(request_id)
+            else:
+                self._last_write.pop(request_id, None)
+
+    def _take_due(self):
+
+        now = time.monotonic()
+        with self._lock:
+            due = {request_id: percentage for request_id, percentage in self._pending.items()
+                   if now - self._last_write.get(request_id, 0) >= self.min_interval}
+            for request_id in due:
+                del self._pending[request_id]
+                if request_id in self._ended:
+                    self._ended.discard(request_id)
+                    self._last_write.pop(request_id, None)
+                else:
+                    self._last_write[request_id] = now
+            next_due = min((self._last_write[request_id] + self.min_interval - now for request_id in self._pending), default=None)
+        return due, next_due
+
+    def _run(self):
+
+        while True:
+            with self._write_lock:
+                due, next_due = self._take_due()
+                for request_id, percentage in due.items():
+                    try:
+                        with trace("supabase", "requests.update_progress", request_id):
+                            get_supabase().table("requests").update({"progress_percentage": percentage}).eq("id", request_id).execute()
+                    except Exception as e:
+                        print(f"✗ Progress update failed for {request_id}: {str(e)}")
+            if self._stopping.is_set() and next_due is None:
+                return
+            self._wakeup.wait(next_due)
+            self._wakeup.clear()
+
+
+progress_reporter = ProgressReporter()
+
+
+def report_progress(request_id: str, percentage: int):
+
+    if request_id:
+        progress_reporter.report(request_id, percentage)
+
+
+def save_report_in_supabase(request_id: str, recommendation: str, impact: float, confidence: float = None, payback_months: float = None):
     """Simplest possible report save"""
-    
+
+    supabase = get_supabase()
+
+    # Runs synthesized without the structured output don't have these, keep the old placeholders
+    confidence = DEFAULT_CONFIDENCE if confidence is None else confidence
+    payback_months = DEFAULT_PAYBACK_MONTHS if payback_months is None else payback_months
+
+    # The status update below sets progress to 100, a late progress write must not land after it
+    progress_reporter.discard(request_id)
+
     # Save to request_outputs
-    supabase.table("request_outputs").upsert({
-        "request_id": request_id,
-        "output_status": "pending_review",
-        "headline_metrics": {
-            "predicted_impact_monthly": impact,
-            "confidence_percentage": 75,
-            "payback_months": 2
-        },
-        "summary_tab": {
-            "bottom_line": recommendation,
-            "key_findings": [],
-            "confidence_score": 75
-        }
-    }, on_conflict="request_id").execute()
-    
-    # Update request status
-    supabase.table("requests").update({
-        "status": "pending-qa",
-        "predicted_impact": impact,
-        "progress_percentage": 100
-    }).eq("id", request_id).execute()
-    
-    print(f"✓ Report saved for {request_id}")
\ No newline at end of file
+    with trace("supabase", "request_outputs.upsert", request_id):
+        supabase.table("request_outputs").upsert({
+            "request_id": request_id,
+            "output_status": "pending_review",
+            "headline_metrics": {
+                "predicted_impact_monthly": impact,
+                "confidence_percentage": confidence,
+                "payback_months": payback_months
+            },
+            "summary_tab": {
+                "bottom_line": recommendation,
+                "key_findings": [],
+                "confidence_score": confidence
+            }
+        }, on_conflict="request_id").execute()
+
+    # Update request status, progress included
+    with trace("supabase", "requests.update_status", request_id):
+        supabase.table("requests").update({
+            "status": "pending-qa",
+            "predicted_impact": impact,
+            "progress_percentage": 100
+        }).eq("id", request_id).execute()
+
+    print(f"✓ Report saved for {request_id}")
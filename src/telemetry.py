@@ -0,0 +1,274 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from src.jobs import current_job
+from dotenv import load_dotenv
+load_dotenv()
+
+# --------------------------------------------
+#     Latency, token and cost instrumentation
+# --------------------------------------------
+
+METRICS_PREFIX = "profit_oracle"
+# Breakdowns of this many recent requests are kept in memory for /jobs/{request_id}
+MAX_TRACKED_REQUESTS = int(os.getenv("MAX_TRACKED_REQUESTS", "1000"))
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# USD per million tokens: input, cached input, output (reasoning tokens are billed as output).
+# Override with OPENAI_PRICES='{"model": [input, cached, output]}' when prices change
+OPENAI_PRICES = {
+    "gpt-5": (1.25, 0.125, 10.0),
+    "gpt-4.1": (2.0, 0.5, 8.0),
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+    "o3-deep-research": (10.0, 2.5, 40.0),
+    "o4-mini-deep-research": (2.0, 0.5, 8.0),
+}
+OPENAI_PRICES.update({model: tuple(prices) for model, prices in json.loads(os.getenv("OPENAI_PRICES", "{}")).items()})
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_requests = OrderedDict()
+
+
+def _request_breakdown(request_id):
+
+    breakdown = _requests.get(request_id)
+    if breakdown is None:
+        breakdown = _requests[request_id] = {"spans": {}, "tokens": {}, "cost_usd": 0.0, "retries": 0}
+        while len(_requests) > MAX_TRACKED_REQUESTS:
+            _requests.popitem(last=False)
+    return breakdown
+
+
+def _increment(name, labels, value=1):
+
+    key = (name, tuple(sorted(labels.items())))
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(kind, name, seconds, status="ok", request_id=None):
+    """Records one timed operation: a graph node, an OpenAI/S3/Supabase call, or time spent queued"""
+
+    request_id = request_id or current_job.get()
+    key = (kind, name, status)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+        if request_id:
+            span = _request_breakdown(request_id)["spans"].setdefault(f"{kind}:{name}", {"count": 0, "seconds": 0.0, "errors": 0})
+            span["count"] += 1
+            span["seconds"] = round(span["seconds"] + seconds, 3)
+            span["errors"] += status != "ok"
+
+
+@contextmanager
+def trace(kind, name, request_id=None):
+
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        observe(kind, name, time.perf_counter() - start, status, request_id)
+
+
+def record_retry(kind, name, retries=1, request_id=None):
+
+    request_id = request_id or current_job.get()
+    with _lock:
+        _increment("retries_total", {"kind": kind, "name": name}, retries)
+        if request_id:
+            _request_breakdown(request_id)["retries"] += retries
+
+
+def count(counter, value=1, **labels):
+    """Adds to a counter exported by /metrics, like how often a duplicate request was served"""
+
+    with _lock:
+        _increment(counter, labels, value)
+
+
+def _price(model):
+
+    # Responses name the dated snapshot (gpt-5-2025-08-07), prices are listed by family
+    matches = [name for name in OPENAI_PRICES if model == name or model.startswith(f"{name}-")]
+    return OPENAI_PRICES[max(matches, key=len)] if matches else None
+
+
+def _get(value, key, default=None):
+
+    # Usage comes either as SDK objects or as the raw JSON of a response
+    if isinstance(value, dict):
+        return value.get(key, default)
+    return getattr(value, key, default)
+
+
+def record_openai_usage(model, usage, request_id=None):
+    """Counts the tokens of one OpenAI response (Responses or Chat Completions usage) and their estimated cost"""
+
+    if not model or not usage:
+        return
+    request_id = request_id or current_job.get()
+
+    input_tokens = _get(usage, "input_tokens", _get(usage, "prompt_tokens")) or 0
+    output_tokens = _get(usage, "output_tokens", _get(usage, "completion_tokens")) or 0
+    input_details = _get(usage, "input_tokens_details", _get(usage, "prompt_tokens_details"))
+    output_details = _get(usage, "output_tokens_details", _get(usage, "completion_tokens_details"))
+    cached_tokens = (_get(input_details, "cached_tokens") or 0) if input_details else 0
+    reasoning_tokens = (_get(output_details, "reasoning_tokens") or 0) if output_details else 0
+    tokens = {"input": input_tokens, "cached": cached_tokens, "output": output_tokens, "reasoning": reasoning_tokens}
+
+    price = _price(model)
+    cost = 0.0
+    if price:
+        cost = ((input_tokens - cached_tokens) * price[0] + cached_tokens * price[1] + output_tokens * price[2]) / 1e6
+
+    with _lock:
+        for token_type, count in tokens.items():
+            _increment("openai_tokens_total", {"model": model, "type": token_type}, count)
+        _increment("openai_cost_usd_total", {"model": model}, cost)
+        if request_id:
+            breakdown = _request_breakdown(request_id)
+            model_tokens = breakdown["tokens"].setdefault(model, dict.fromkeys(tokens, 0))
+            for token_type, count in tokens.items():
+                model_tokens[token_type] += count
+            breakdown["cost_usd"] = round(breakdown["cost_usd"] + cost, 6)
+
+
+def get_breakdown(request_id):
+    """Where a request's time and money went, or None if this process hasn't seen it"""
+
+    with _lock:
+        breakdown = _requests.get(request_id)
+        return json.loads(json.dumps(breakdown)) if breakdown else None
+
+
+# --------------------------------------------
+#          Hooks for the HTTP clients
+# --------------------------------------------
+
+def _endpoint(request):
+
+    # Ids in the path (resp_..., file-..., cntr_...) would make a label per call
+    path = re.sub(r"/[A-Za-z]+[-_][A-Za-z0-9_-]{8,}", "/{id}", request.url.path)
+    return f"{request.method} {path}"
+
+
+async def _on_openai_request(request):
+
+    request.extensions["telemetry_start"] = time.perf_counter()
+    # The SDK numbers its own retries in this header
+    retries = int(request.headers.get("x-stainless-retry-count", "0") or 0)
+    if retries:
+        record_retry("openai", _endpoint(request))
+
+
+async def _on_openai_response(response):
+
+    request = response.request
+    if "json" in response.headers.get("content-type", ""):
+        # JSON bodies are small, read here so the usage can be counted; the SDK reuses the read body
+        await response.aread()
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if isinstance(body, dict):
+            record_openai_usage(body.get("model"), body.get("usage"))
+    start = request.extensions.get("telemetry_start")
+    if start is not None:
+        observe("openai", _endpoint(request), time.perf_counter() - start, "ok" if response.status_code < 400 else "error")
+
+
+def openai_event_hooks():
+    """httpx event hooks timing every OpenAI request and counting the tokens of every JSON response"""
+
+    return {"request": [_on_openai_request], "response": [_on_openai_response]}
+
+
+def instrument_s3(s3_client):
+    """Times every S3 operation of a boto3 client and counts botocore's retries"""
+
+    def before_call(model, context, **kwargs):
+        context["telemetry_start"] = time.perf_counter()
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        start = context.get("telemetry_start")
+        if start is not None:
+            observe("s3", model.name, time.perf_counter() - start, "ok" if http_response.status_code < 400 else "error")
+        retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        if retries:
+            record_retry("s3", model.name, retries)
+
+    s3_client.meta.events.register("before-call.s3", before_call)
+    s3_client.meta.events.register("after-call.s3", after_call)
+    return s3_client
+
+
+# --------------------------------------------
+#          Prometheus text exposition
+# --------------------------------------------
+
+def _labels(labels):
+
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{key}="{escape(value)}"' for key, value in labels)
+
+
+def _number(value):
+
+    return str(int(value)) if float(value).is_integer() else f"{value:.6f}"
+
+
+def render_metrics(gauges=None):
+    """
+    All metrics in the Prometheus text format.
+
+    gauges: optional {name: {label tuple: value}} of point-in-time values owned by
+    other modules (queue depth, cache size...), rendered alongside.
+    """
+    lines = []
+    with _lock:
+        histograms = {key: {**value, "buckets": list(value["buckets"])} for key, value in _histograms.items()}
+        counters = dict(_counters)
+
+    name = f"{METRICS_PREFIX}_span_seconds"
+    lines += [f"# HELP {name} Wall time of graph nodes, OpenAI, S3 and Supabase calls and queue waits",
+              f"# TYPE {name} histogram"]
+    for (kind, span_name, status), histogram in sorted(histograms.items()):
+        labels = _labels([("kind", kind), ("name", span_name), ("status", status)])
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram['sum']:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {histogram['count']}")
+
+    for counter in sorted({key[0] for key in counters}):
+        name = f"{METRICS_PREFIX}_{counter}"
+        lines.append(f"# TYPE {name} counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == counter:
+                lines.append(f"{name}{{{_labels(labels)}}} {_number(value)}")
+
+    for gauge, values in (gauges or {}).items():
+        name = f"{METRICS_PREFIX}_{gauge}"
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values.items():
+            lines.append(f"{name}{{{_labels(labels)}}} {_number(value)}" if labels else f"{name} {_number(value)}")
+
+    return "\n".join(lines) + "\n"